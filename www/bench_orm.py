@@ -0,0 +1,67 @@
+# coding=utf-8
+
+__author__ = "Liu Cong"
+
+"""
+filename: www.bench_orm.py
+create time: 2026-10-19
+disc: bench_orm.py
+    ORM的性能测试，不需要连接数据库，直接使用构造好的记录：
+        python bench_orm.py
+"""
+
+import gc, sys, time
+
+from transwarp import db
+from models import Comment
+
+def _rows(n):
+    names = ['id', 'blog_id', 'user_id', 'user_name', 'user_image', 'created_at']
+    now = time.time()
+    rows = [(db.next_id(now), u'blog', u'user', u'Michael', u'about:blank', now) for i in xrange(n)]
+    return names, rows
+
+def _timeit(title, fn, *args):
+    gc.disable()  # 大量对象分配时不让gc的开销影响结果
+    start = time.time()
+    r = fn(*args)
+    gc.enable()
+    print '%-40s %8.3fs' % (title, time.time() - start)
+    return r
+
+def bench_hydrate(n=1000000):
+    """
+    从记录tuple构造Model对象：旧的 tuple -> db.Dict -> cls(**d) 与 Model._from_rows()
+    """
+    names, rows = _rows(n)
+    print 'hydrate %d rows:' % n
+    _timeit('  tuple -> db.Dict -> Comment(**d)', lambda: [Comment(**db.Dict(names, r)) for r in rows])
+    _timeit('  Comment._from_rows(names, rows)', Comment._from_rows, names, rows)
+
+def _sizeof(m):
+    """
+    对象本身加上实例__dict__(dict实现的Model中记录未加载字段的_unloaded)占用的字节数，
+    sys.getsizeof()不包括实例的__dict__
+    """
+    size = sys.getsizeof(m)
+    try:
+        d = object.__getattribute__(m, '__dict__')
+    except AttributeError:
+        # __slots__对象没有__dict__
+        return size
+    return size + sys.getsizeof(d) if d else size
+
+def bench_memory(n=100000):
+    """
+    n个Comment对象本身占用的内存(不包括共享的字段值)：dict实现的Model与只读的__slots__对象
+    """
+    names, rows = _rows(n)
+    print 'memory of %d comments:' % n
+    for title, readonly in (('  Comment (dict)', False), ('  ReadOnlyComment (__slots__)', True)):
+        L = _timeit(title, Comment._from_rows, names, rows, readonly)
+        size = sum([_sizeof(m) for m in L])
+        print '%-40s %8.1fMB, %d bytes per object' % ('', size / 1024.0 / 1024.0, size / n)
+
+if __name__ == '__main__':
+    bench_hydrate()
+    bench_memory()
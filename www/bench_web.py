@@ -0,0 +1,172 @@
+# coding=utf-8
+
+__author__ = "Liu Cong"
+
+"""
+filename: www.bench_web.py
+create time: 2026-10-19
+disc: bench_web.py
+    web框架的性能测试，不需要启动服务器：
+        python bench_web.py
+"""
+
+import cgi, gc, os, shutil, tempfile, time
+from cStringIO import StringIO
+
+from transwarp.web import Route, RouteTrie, Request, WSGIApplication, Jinja2TemplateEngine, get, interceptor
+
+def _timeit(title, fn, *args):
+    gc.disable()
+    start = time.time()
+    r = fn(*args)
+    gc.enable()
+    print '%-40s %8.3fs' % (title, time.time() - start)
+    return r
+
+def _routes(n):
+    """
+    n个动态路由，形如 /api/r<i>/:id 和 /manage/r<i>/:id/edit
+    """
+    L = []
+    for i in xrange(n):
+        def fn(*args):
+            return args
+        fn.__web_route__ = '/api/r%d/:id' % i if i % 2 == 0 else '/manage/r%d/:id/edit' % i
+        fn.__web_method__ = 'GET'
+        L.append(Route(fn))
+    return L
+
+def bench_dispatch(n=500, loop=20000):
+    """
+    动态路由的分发：逐个匹配Route的正则与RouteTrie
+    """
+    routes = _routes(n)
+    trie = RouteTrie()
+    for route in routes:
+        trie.add(route)
+    # 最坏情况：最后注册的路由
+    url = '/manage/r%d/123/edit' % (n - 1)
+
+    def linear():
+        for i in xrange(loop):
+            for route in routes:
+                args = route.match(url)
+                if args:
+                    break
+
+    def compiled():
+        for i in xrange(loop):
+            trie.match(url)
+
+    print 'dispatch %s to %d routes, %d times:' % (url, n, loop)
+    _timeit('  linear Route.match()', linear)
+    _timeit('  RouteTrie.match()', compiled)
+
+def _environ(path, method='GET'):
+    return dict(REQUEST_METHOD=method, PATH_INFO=path)
+
+def _start_response(status, headers):
+    pass
+
+def bench_interceptors(loop=50000):
+    """
+    一个请求经过的拦截器数量不同时，wsgi处理函数的耗时
+    """
+    @get('/blog/:id')
+    def blog(id):
+        return 'blog'
+
+    def _interceptor(pattern):
+        @interceptor(pattern)
+        def fn(next_fn):
+            return next_fn()
+        return fn
+
+    print 'request /blog/123 with interceptors, %d times:' % loop
+    for n in (0, 3, 6, 12):
+        app = WSGIApplication()
+        app.add_url(blog)
+        for i in xrange(n):
+            # 一半拦截器匹配该请求
+            app.add_interceptor(_interceptor('/' if i % 2 == 0 else '/manage/'))
+        wsgi = app.get_wsgi_application()
+        env = _environ('/blog/123')
+
+        def run():
+            for i in xrange(loop):
+                wsgi(env, _start_response)
+
+        _timeit('  %d interceptors' % n, run)
+
+def bench_templates(templ_dir=None):
+    """
+    每个模板第一次请求的耗时(加载和渲染)，模拟新启动的worker进程：
+    每次编译、从bytecode cache加载、启动时precompile()之后
+    """
+    templ_dir = templ_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # 先生成bytecode cache，模拟上一次部署之后已经运行过的进程：
+        Jinja2TemplateEngine(templ_dir, bytecode_cache_dir=cache_dir).precompile()
+        print 'first request per template in %s:' % templ_dir
+        for name in Jinja2TemplateEngine(templ_dir)._env.list_templates():
+            for title, kw, precompile in (('compile', dict(), False),
+                                          ('bytecode cache', dict(bytecode_cache_dir=cache_dir), False),
+                                          ('precompile()', dict(bytecode_cache_dir=cache_dir, auto_reload=False), True)):
+                engine = Jinja2TemplateEngine(templ_dir, **kw)
+                if precompile:
+                    engine.precompile()
+                start = time.time()
+                engine(name, dict())
+                print '  %-30s %-16s %8.3fms' % (name, title, (time.time() - start) * 1000)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def _cgi_parse(environ):
+    """
+    原来的解析方式：cgi.FieldStorage并且把所有值转换为unicode
+    """
+    fs = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=True)
+    inputs = dict()
+    for key in fs:
+        item = fs[key]
+        inputs[key] = [i.value.decode('utf-8') for i in item] if isinstance(item, list) else (item.file if item.filename else item.value.decode('utf-8'))
+    return inputs
+
+def _request_parse(environ):
+    r = Request(environ)
+    return r.get('f0')
+
+def bench_form(loop=20000):
+    """
+    解析1KB的x-www-form-urlencoded表单，读取一个参数
+    """
+    body = '&'.join(['f%d=%s' % (i, 'v' * 40) for i in xrange(22)])
+    print 'parse %d bytes form, %d times:' % (len(body), loop)
+    for title, fn in (('  cgi.FieldStorage', _cgi_parse), ('  Request', _request_parse)):
+        def run():
+            for i in xrange(loop):
+                fn({'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                    'CONTENT_LENGTH': str(len(body)), 'QUERY_STRING': '', 'wsgi.input': StringIO(body)})
+        _timeit(title, run)
+
+def bench_upload(size=100 * 1024 * 1024):
+    """
+    解析上传100MB文件的multipart/form-data
+    """
+    boundary = '----WebKitFormBoundaryQQ3J8kPsjFpTmqNz'
+    data = ('0123456789abcdef' * 64 + '\r\n') * (size // 1026)
+    body = '\r\n'.join(['--' + boundary, 'Content-Disposition: form-data; name="f0"; filename="big.bin"',
+                         'Content-Type: application/octet-stream', '', data, '--' + boundary + '--', ''])
+    print 'parse %d MB upload:' % (len(body) // 1024 // 1024)
+    for title, fn in (('  cgi.FieldStorage', _cgi_parse), ('  Request', _request_parse)):
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % boundary,
+                   'CONTENT_LENGTH': str(len(body)), 'QUERY_STRING': '', 'wsgi.input': StringIO(body)}
+        _timeit(title, fn, environ)
+
+if __name__ == '__main__':
+    bench_dispatch()
+    bench_interceptors()
+    bench_templates()
+    bench_form()
+    bench_upload()
@@ -0,0 +1,26 @@
+# coding=utf-8
+
+__author__ = "Liu Cong"
+
+"""
+filename: www.build_assets.py
+create time: 2026-10-19
+disc: build_assets.py
+    为static目录下的文件生成带指纹的副本、gzip预压缩文件和manifest.json，保存到dist目录：
+        python build_assets.py            # 保存到www/dist
+        python build_assets.py <dist目录>
+    模板中使用 {{ 'css/app.css'|asset }} 引用带指纹的url。
+"""
+
+import logging; logging.basicConfig(level=logging.INFO)
+import os, sys
+
+from transwarp.web import build_assets
+
+def main(dist_dir=None):
+    document_root = os.path.dirname(os.path.abspath(__file__))
+    manifest = build_assets(document_root, dist_dir)
+    print '%d assets built.' % len(manifest)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -17,6 +17,13 @@ configs = {
         'password': '123456',
         'database': 'awesome'
     },
+    # comments表的分片，每一项是与db相同的连接参数，为空时不分片
+    'shards': [],
+    # jinja2模板：auto_reload检查模板文件的修改，bytecode_cache为保存编译后的模板的目录(相对路径相对于www目录)
+    'templates': {
+        'auto_reload': True,
+        'bytecode_cache': None
+    },
     'session': {
         'secret': 'AwEsOmE'
     }
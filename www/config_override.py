@@ -9,8 +9,15 @@ disc: config_override
     config_override.py作为生产环境的标准配置。
 """
 
+import os
+
 configs = {
     'db': {
         'host': '127.0.0.1'
+    },
+    'templates': {
+        'auto_reload': False,
+        # 编译后的模板保存在www/cache/jinja2，与进程的工作目录无关
+        'bytecode_cache': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'jinja2')
     }
 }
\ No newline at end of file
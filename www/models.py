@@ -11,7 +11,7 @@ disc: Models
 import time, uuid
 
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, IntegerField, TextField, VersionField
 
 class User(Model):
     """
@@ -20,12 +20,19 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=False, ddl='varchar(50)')
+    email = StringField(updatable=False, unique=True, ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
-    admin = BooleanField()
+    admin = BooleanField(coerce=True)
     name = StringField(dll='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(updatable=False, default=time.time)
+    created_at = FloatField(updatable=False, index=True, default=time.time)
+
+    def update_denormalized(self):
+        """
+        用户修改了名字或头像后，批量修改blogs和comments表中冗余的user_name和user_image
+        """
+        Blog.update_where('where user_id=?', [self.id], user_name=self.name, user_image=self.image)
+        Comment.update_where('where user_id=?', [self.id], user_name=self.name, user_image=self.image)
 
 class Blog(Model):
     """
@@ -40,13 +47,18 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
+    created_at = FloatField(updatable=False, index=True, default=time.time)
+    version = VersionField()
+    comment_count = IntegerField(updatable=False)  # 由Comment的__counter_cache__维护
 
 class Comment(Model):
     """
     comment表
     """
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at')]  # 按blog查询评论并按时间排序
+    __shard_key__ = 'blog_id'  # 配置了分片(configs.shards)时按blog_id分片
+    __counter_cache__ = [('blog_id', Blog, 'comment_count')]
 
     id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
     blog_id = StringField(updatable=False, ddl='varchar(50)')
@@ -54,4 +66,4 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
\ No newline at end of file
+    created_at = FloatField(updatable=False, index=True, default=time.time)
\ No newline at end of file
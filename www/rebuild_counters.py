@@ -0,0 +1,23 @@
+# coding=utf-8
+
+__author__ = "Liu Cong"
+
+"""
+filename: www.rebuild_counters.py
+create time: 2026-10-19
+disc: rebuild_counters.py
+    按子表重新统计Model中__counter_cache__声明的计数字段(如blogs.comment_count)：
+        python rebuild_counters.py
+"""
+
+from transwarp import db
+from models import Comment
+from config import configs
+
+def main():
+    db.create_engine(**configs.db)
+    for model in (Comment,):
+        print '%s: %s rows updated.' % (model.__name__, model.rebuild_counters())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# coding=utf-8
+
+__author__ = "Liu Cong"
+
+"""
+filename: www.schema_sync.py
+create time: 2026-10-19
+disc: schema_sync.py
+    对比models.py中的Model定义和数据库中的表结构，输出同步表结构需要执行的sql语句：
+        python schema_sync.py            # 只输出sql语句
+        python schema_sync.py --execute  # 输出并执行sql语句
+"""
+
+import sys
+
+from transwarp import db
+from transwarp.orm import schema_diff
+from models import User, Blog, Comment
+from config import configs
+
+def main(execute=False):
+    db.create_engine(**configs.db)
+    for model in (User, Blog, Comment):
+        for sql in schema_diff(model):
+            print sql
+            if execute and not sql.startswith('--'):
+                db.update(sql)
+
+if __name__ == '__main__':
+    main('--execute' in sys.argv[1:])
@@ -60,12 +60,13 @@ class MultiColumnsError(DBError):
 
 class _LasyConnection(object):
 
-    def __init__(self):
+    def __init__(self, eng=None):
         self.connection = None
+        self._engine = eng  # 为None时使用全局的engine
 
     def cursor(self):
         if self.connection is None:
-            conn = engine.connect()
+            conn = (self._engine or engine).connect()
             logging.info('open connection <%s>...' % hex(id(conn)))
             self.connection = conn
         return self.connection.cursor()
@@ -91,14 +92,16 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.after_commit = []  # 事务提交后需要执行的函数
 
     def is_init(self):
         return self.connection is not None
 
-    def init(self):
+    def init(self, eng=None):
         logging.info('open lazy connection...')
-        self.connection = _LasyConnection()
+        self.connection = _LasyConnection(eng)
         self.transactions = 0
+        self.after_commit = []
 
     def cleanup(self):
         self.connection.cleanup()
@@ -126,6 +129,13 @@ def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    engine = make_engine(user, password, database, host, port, **kw)
+    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+
+def make_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+    """
+    创建一个数据库引擎对象但不设置为全局的engine，用于连接多个数据库(例如分片)，配合using()使用。
+    """
     params = dict(
         user=user
         , password=password
@@ -145,8 +155,7 @@ def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
     # 再把剩余的kw元素加到params中
     params.update(kw)
     params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    return _Engine(lambda: mysql.connector.connect(**params))
 
 class _ConnectionCtx(object):
     """
@@ -169,6 +178,33 @@ class _ConnectionCtx(object):
 def connection():
     return _ConnectionCtx()
 
+class _EngineCtx(object):
+    """
+    切换当前线程使用的数据库引擎，with语句中的数据库操作都使用该引擎的连接，退出时恢复原来的连接。
+    """
+    def __init__(self, eng):
+        self._engine = eng
+
+    def __enter__(self):
+        global _db_ctx
+        self._saved = (_db_ctx.connection, _db_ctx.transactions, _db_ctx.after_commit)
+        _db_ctx.init(self._engine)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _db_ctx
+        try:
+            _db_ctx.cleanup()
+        finally:
+            _db_ctx.connection, _db_ctx.transactions, _db_ctx.after_commit = self._saved
+
+def using(eng):
+    """
+    with using(eng):
+        select(...)
+    """
+    return _EngineCtx(eng)
+
 # 装饰器--connection
 def with_connection(func):
     @functools.wraps(func)
@@ -210,18 +246,36 @@ class _TransactionCtx(object):
         except:
             logging.warning('commit failed. try rollback...')
             _db_ctx.connection.rollback()
+            _db_ctx.after_commit = []
             logging.warning('rollback ok.')
             raise
+        hooks, _db_ctx.after_commit = _db_ctx.after_commit, []
+        for fn in hooks:
+            try:
+                fn()
+            except Exception:
+                logging.exception('after commit hook failed.')
 
     def rollback(self):
         global _db_ctx
         logging.warning('rollback transaction...')
+        _db_ctx.after_commit = []
         _db_ctx.connection.rollback()
         logging.info('rollback ok.')
 
 def transaction():
     return _TransactionCtx()
 
+def after_commit(fn):
+    """
+    在当前事务成功提交后执行fn，事务回滚时不执行。不在事务中时立即执行。
+    """
+    global _db_ctx
+    if _db_ctx.is_init() and _db_ctx.transactions > 0:
+        _db_ctx.after_commit.append(fn)
+    else:
+        fn()
+
 def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kw):
@@ -231,13 +285,13 @@ def with_transaction(func):
         # _profiling(_start)
     return _wrapper
 
-def _select(sql, first, *args):
+def _select_rows(sql, first, *args):
     """
-    执行查询SQL语句，并根据first值来决定返回一个结果还是list结果集。
+    执行查询SQL语句，返回字段名list和数据库返回的原始tuple，不构造Dict。
     :param sql: 查询sql语句，参数用?代替。
     :param first: bool值，是否只取结果集中的第一条记录。
     :param args: sql语句中?的参数。
-    :return:
+    :return: (names, values)，first为True时values是一条记录(或None)，否则是记录的list。
     """
     global _db_ctx
     cursor = None
@@ -252,15 +306,27 @@ def _select(sql, first, *args):
             names = [x[0] for x in cursor.description]
         # 如果first为true，则返回第一个结果
         if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return names, cursor.fetchone()
+        return names, cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
 
+def _select(sql, first, *args):
+    """
+    执行查询SQL语句，并根据first值来决定返回一个结果还是list结果集。
+    :param sql: 查询sql语句，参数用?代替。
+    :param first: bool值，是否只取结果集中的第一条记录。
+    :param args: sql语句中?的参数。
+    :return:
+    """
+    names, values = _select_rows(sql, first, *args)
+    if first:
+        if not values:
+            return None
+        return Dict(names, values)
+    return [Dict(names, x) for x in values]
+
 @with_connection
 def select_one(sql, *args):
     '''
@@ -336,6 +402,22 @@ def select(sql, *args):
     '''
     return _select(sql, False, *args)
 
+@with_connection
+def select_rows(sql, *args):
+    '''
+    Execute select SQL and return (names, rows) where rows are the raw tuples from the cursor.
+    Used by the ORM to build objects without creating a Dict for each row.
+    >>> u1 = dict(id=300, name='Jack', email='jack@test.org', passwd='jack', last_modified=time.time())
+    >>> insert('user', **u1)
+    1
+    >>> names, rows = select_rows('select id, name from user where id=?', 300)
+    >>> [str(n) for n in names]
+    ['id', 'name']
+    >>> rows
+    [(300, u'Jack')]
+    '''
+    return _select_rows(sql, False, *args)
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
@@ -373,6 +455,23 @@ def insert(table, **kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+def insert_many(table, cols, rows):
+    '''
+    Execute one multi-row insert SQL for all rows.
+    >>> insert_many('user', ['id', 'name', 'email', 'passwd', 'last_modified'], [(3000, 'A', 'a@test.org', 'a', time.time()), (3001, 'B', 'b@test.org', 'b', time.time())])
+    2
+    >>> select_int('select count(*) from user where id>=3000 and id<=3001')
+    2
+    '''
+    if not rows:
+        return 0
+    row_sql = '(%s)' % ','.join(['?' for i in range(len(cols))])
+    sql = 'insert into `%s` (%s) values %s' % (table, ','.join(['`%s`' % col for col in cols]), ','.join([row_sql] * len(rows)))
+    args = []
+    for row in rows:
+        args.extend(row)
+    return _update(sql, *args)
+
 def update(sql, *args):
     r'''
     Execute update SQL.
@@ -14,13 +14,14 @@ disc: ORM module.
 """
 
 import db
-import time, logging
+import re, time, logging, threading, collections, itertools, functools, operator, zlib, sys, atexit
 
 class Field(object):
     """
     负责保存数据库表中的字段属性的基类。
     """
     _count = 0  # 字段排序编号
+    _coerce = None  # coerce=True时使用的类型转换函数
 
     def __init__(self, **kw):
         self.name = kw.get('name', None)                # 字段名
@@ -30,6 +31,11 @@ class Field(object):
         self.updatable = kw.get('updatable', True)      # 字段是否可修改，默认是
         self.insertable = kw.get('insertable', True)    # 字段是否可插入，默认是
         self.ddl = kw.get('ddl', '')                    # 字段类型
+        self.deferred = kw.get('deferred', False)       # 字段是否延迟加载，默认否
+        self.index = kw.get('index', False)             # 字段是否建立索引，默认否
+        self.unique = kw.get('unique', False)           # 字段是否建立唯一索引，默认否
+        coerce = kw.get('coerce', False)                # 加载时是否转换字段值的类型，可以是True或者转换函数
+        self.coerce = (coerce if callable(coerce) else self._coerce) if coerce else None
         self._order = Field._count                      # 字段排序，_count越小，排在越前面
         Field._count = Field._count + 1
 
@@ -47,6 +53,7 @@ class Field(object):
         self.nullable and s.append('N')
         self.updatable and s.append('U')
         self.insertable and s.append('I')
+        self.deferred and s.append('D')
         s.append('>')
         return ''.join(s)
 
@@ -65,6 +72,8 @@ class IntegerField(Field):
     """
     整数类型的Field
     """
+    _coerce = long
+
     def __init__(self, **kw):
         if 'default' not in kw:
             kw['default'] = 0
@@ -76,6 +85,8 @@ class FloatField(Field):
     """
     浮点类型的Field
     """
+    _coerce = float
+
     def __init__(self, **kw):
         if 'default' not in kw:
             kw['default'] = 0.0
@@ -87,6 +98,8 @@ class BooleanField(Field):
     """
     布尔类型的Field
     """
+    _coerce = bool
+
     def __init__(self, **kw):
         if 'default' not in kw:
             kw['default'] = False
@@ -103,6 +116,8 @@ class TextField(Field):
             kw['default'] = ''
         if 'ddl' not in kw:
             kw['ddl'] = 'text'
+        if 'deferred' not in kw:
+            kw['deferred'] = True
         super(TextField, self).__init__(**kw)
 
 class BlobField(Field):
@@ -114,26 +129,146 @@ class BlobField(Field):
             kw['default'] = ''
         if 'ddl' not in kw:
             kw['ddl'] = 'blob'
+        if 'deferred' not in kw:
+            kw['deferred'] = True
         super(BlobField, self).__init__(**kw)
 
 class VersionField(Field):
+    """
+    版本号Field，用于乐观锁：每次update()时检查版本号并加1
+    """
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
+class ConflictError(db.DBError):
+    """
+    乐观锁冲突：update()时记录的版本号已经被其他人修改
+    """
+    pass
+
 """ ...等等其他类型的Field """
 
+######################二级缓存(按主键缓存)######################
+class CacheBackend(object):
+    """
+    缓存后端的接口，value都是可以被pickle的dict。
+    实现该接口(例如基于memcached或redis)即可在多个worker进程之间共享缓存。
+    """
+    def get(self, key):
+        """
+        :return: 缓存的值，不存在或已过期时返回None
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+class LRUCache(CacheBackend):
+    """
+    进程内的LRU缓存，限制最大条数，每一条记录在ttl秒后过期。
+
+    >>> c = LRUCache(size=2)
+    >>> c.set('a', 1, 60)
+    >>> c.set('b', 2, 60)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3, 60)
+    >>> c.get('b')
+    >>> c.get('c')
+    3
+    >>> c.set('d', 4, -1)
+    >>> c.get('d')
+    """
+    def __init__(self, size=1000):
+        self._size = size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                return None
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+class _ModelCache(object):
+    """
+    Model的主键缓存，由类属性__cache__声明：
+
+        __cache__ = True
+        __cache__ = dict(size=10000, ttl=60)
+        __cache__ = dict(backend=MemcacheBackend(...), ttl=60)
+    """
+    def __init__(self, table, options):
+        if not isinstance(options, dict):
+            options = dict()
+        self.ttl = options.get('ttl', 300)
+        self.backend = options.get('backend') or LRUCache(options.get('size', 1000))
+        self.prefix = '%s:' % table
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pk):
+        d = self.backend.get('%s%s' % (self.prefix, pk))
+        if d is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+        return d
+
+    def set(self, pk, d):
+        self.backend.set('%s%s' % (self.prefix, pk), dict(d), self.ttl)
+
+    def delete(self, pk):
+        self.backend.delete('%s%s' % (self.prefix, pk))
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+##################################################################
+
 # 触发器
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
-def _gen_sql(table_name, mappings):
+def _gen_index_sql(index):
+    """
+    生成索引定义的sql字符串
+    :param index: (索引名, 字段名tuple, 是否唯一)
+    :return: 类似于 unique key `idx_email` (`email`)
+    """
+    name, columns, unique = index
+    return '%skey `%s` (%s)' % ('unique ' if unique else '', name, ','.join(['`%s`' % c for c in columns]))
+
+def _gen_sql(table_name, mappings, indexes=()):
     """
     动态生成创建表的sql语句字符串
     :param table_name: 表名  str
     :param mappings: 表字段  {字段key1: 字段实例1, 字段key2: 字段实例2, ...}
+    :param indexes: 索引  [(索引名, 字段名tuple, 是否唯一), ...]
     :return: 返回sql字符串，类似于如下：
             CREATE TABLE t1(
               id int not null,
               name char(20),
+              key `idx_name` (`name`),
               primary key (id)
             );
     """
@@ -147,10 +282,282 @@ def _gen_sql(table_name, mappings):
         if f.primary_key:
             pk = f.name
         sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
+    for index in indexes:
+        sql.append('  %s,' % _gen_index_sql(index))
     sql.append('  primary key(`%s`)' % pk)
     sql.append(');')
     return '\n'.join(sql)
 
+def _gen_indexes(name, mappings, indexes):
+    """
+    由字段的index/unique属性和__indexes__类属性生成索引list
+    :param indexes: __indexes__类属性，每一项是字段名tuple，或者dict(columns=[...], unique=True, name='...')
+    :return: [(索引名, 字段名tuple, 是否唯一), ...]
+    """
+    L = []
+    for f in sorted(mappings.values(), key=lambda f: f._order):
+        if (f.index or f.unique) and not f.primary_key:
+            L.append(('idx_%s' % f.name, (f.name,), f.unique))
+    for index in indexes:
+        if not isinstance(index, dict):
+            index = dict(columns=index)
+        for c in index['columns']:
+            if c not in mappings:
+                raise TypeError('Unknown column "%s" in __indexes__ of class: %s' % (c, name))
+        columns = tuple([mappings[c].name for c in index['columns']])
+        L.append((index.get('name', 'idx_%s' % '_'.join(columns)), columns, index.get('unique', False)))
+    return L
+
+######################分片######################
+class ShardRouter(object):
+    """
+    把分片键的值映射到多个数据库引擎中的一个，默认按crc32取模：
+
+        Comment.__shards__ = ShardRouter([db.make_engine(**c) for c in configs.shards])
+    """
+    def __init__(self, engines, fn=None):
+        """
+        :param engines: db.make_engine()创建的数据库引擎list
+        :param fn: 可选的函数，把分片键的值转换成整数，默认使用crc32
+        """
+        self.engines = list(engines)
+        self._fn = fn or _crc32
+
+    def shard_for(self, value):
+        return self._fn(value) % len(self.engines)
+
+    def engine_for(self, value):
+        return self.engines[self.shard_for(value)]
+
+def _crc32(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return zlib.crc32(str(value)) & 0xffffffff
+
+def _fan_out(engines, fn, *args):
+    """
+    在每个分片上用单独的线程并行执行fn，每个线程使用各自分片的连接。
+    :return: 每个分片的结果list，顺序与engines一致
+    """
+    results = [None] * len(engines)
+    errors = []
+    def _run(i, eng):
+        try:
+            with db.using(eng):
+                results[i] = fn(*args)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=_run, args=(i, eng)) for i, eng in enumerate(engines)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+def _parse_order(order_by):
+    """
+    '-id' => [('id', True)]
+    """
+    if not order_by:
+        return ()
+    if isinstance(order_by, basestring):
+        order_by = [order_by]
+    return [(o[1:], True) if o.startswith('-') else (o, False) for o in order_by]
+
+def _merge(lists, order=(), offset=None, limit=None):
+    """
+    合并各分片的查询结果。各分片的结果已经排好序，timsort可以直接利用这些有序的片段。
+    :param lists: 各分片的结果list
+    :param order: [(字段名, 是否降序), ...]
+    """
+    if len(lists) == 1 and not offset and limit is None:
+        return lists[0]
+    L = list(itertools.chain(*lists))
+    for name, desc in reversed(order):
+        L.sort(key=operator.itemgetter(name), reverse=desc)
+    start = offset or 0
+    return L[start:] if limit is None else L[start:start + limit]
+
+def _sharded(func):
+    """
+    装饰器：Model的实例方法(insert/update/delete/upsert)在分片键对应的分片上执行
+    """
+    @functools.wraps(func)
+    def _wrapper(self, *args, **kw):
+        router = self.__shards__
+        if router is None:
+            return func(self, *args, **kw)
+        key = self.__shard_key__
+        if key not in self:
+            self[key] = self.__mappings__[key].default
+        with db.using(router.engine_for(self[key])):
+            return func(self, *args, **kw)
+    return _wrapper
+##################################################################
+
+######################计数缓存######################
+def _gen_counter_cache(name, mappings, counters):
+    """
+    检查__counter_cache__类属性
+    :param counters: [(外键字段名, 父Model, 父Model中的计数字段名), ...]
+    """
+    L = []
+    for fk, parent, column in counters:
+        if fk not in mappings:
+            raise TypeError('Unknown column "%s" in __counter_cache__ of class: %s' % (fk, name))
+        if column not in parent.__mappings__:
+            raise TypeError('Unknown column "%s" of %s in __counter_cache__ of class: %s' % (column, parent.__name__, name))
+        if parent.__mappings__[column].updatable:
+            # 计数字段只能通过累加修改，update()写回旧值会覆盖并发的累加
+            logging.warning('NOTE: change counter column %s.%s to non-updatable.' % (parent.__name__, column))
+            parent.__mappings__[column].updatable = False
+        L.append((fk, parent, column))
+    return tuple(L)
+
+def _counter_engine(model, parent, value):
+    """
+    父Model中的计数字段所在的数据库：
+    父Model分片时按主键路由，父Model不分片而子Model分片时使用全局的engine。
+    :return: db.using()，与子Model在同一个数据库时返回None
+    """
+    if parent.__shards__ is not None:
+        if parent.__shard_key__ != parent.__primary_key__.name:
+            raise ValueError('Counter cache requires %s to be sharded by primary key.' % parent.__name__)
+        return db.using(parent.__shards__.engine_for(value))
+    if model.__shards__ is not None:
+        return db.using(None)
+    return None
+
+def _incr_counter(parent, column, value, delta, engine=None):
+    with engine or _NoShardCtx():
+        db.update('update `%s` set `%s`=`%s`+? where `%s`=?' % (parent.__table__, column, column, parent.__primary_key__.name), delta, value)
+        if parent.__cache__:
+            db.after_commit(functools.partial(parent.__cache__.delete, value))
+
+def _with_counter_cache(func):
+    """
+    装饰器：声明了__counter_cache__的Model在一个事务中执行insert/delete和计数的累加
+    """
+    @functools.wraps(func)
+    def _wrapper(self, *args, **kw):
+        if not self.__counter_cache__:
+            return func(self, *args, **kw)
+        with db.transaction():
+            return func(self, *args, **kw)
+    return _wrapper
+##################################################################
+
+_RE_LIMIT = re.compile(r'\blimit\b', re.IGNORECASE)
+# 结尾的锁定子句，limit必须在它之前：for update [nowait|skip locked]、for share、lock in share mode
+_RE_LOCKING = re.compile(r'\s+(for\s+(update|share)\b[\w\s]*|lock\s+in\s+share\s+mode)\s*$', re.IGNORECASE)
+
+def _limit_one(where):
+    """
+    在where clause中加上limit 1，已有limit时不变
+
+    >>> _limit_one('where id=?')
+    'where id=? limit 1'
+    >>> _limit_one('where id=? for update')
+    'where id=? limit 1 for update'
+    >>> _limit_one('where id=? LOCK IN SHARE MODE')
+    'where id=? limit 1 LOCK IN SHARE MODE'
+    >>> _limit_one('order by id limit 2')
+    'order by id limit 2'
+    """
+    if _RE_LIMIT.search(where):
+        return where
+    m = _RE_LOCKING.search(where)
+    if m:
+        return '%s limit 1%s' % (where[:m.start()], where[m.start():])
+    return where + ' limit 1'
+
+def _load_column(model, pk, key, shard=None):
+    """
+    按主键从数据库中单独加载一个字段，用于延迟加载。
+    :param model: Model的子类
+    :param pk: 主键值
+    :param key: 字段名
+    :param shard: 分片键的值
+    :return: 字段值，字段不存在或记录不存在时抛出KeyError
+    """
+    if key not in model.__mappings__ or key == model.__primary_key__.name:
+        raise KeyError(key)
+    d = model._on_shards(shard, db.select_one, 'select `%s` from `%s` where `%s`=?' % (key, model.__table__, model.__primary_key__.name), pk)[0]
+    if d is None:
+        raise KeyError(key)
+    value = d[key]
+    coerce = model.__mappings__[key].coerce
+    if coerce and value is not None:
+        value = coerce(value)
+    return value
+
+class ReadOnlyModel(object):
+    """
+    只读的Model，用于只需要读取的查询结果(例如列表页)，比dict实现的Model占用更少的内存。
+    每个Model子类都由ModelMetaclass生成一个对应的只读类(Model.__readonly__)，
+    它的__slots__就是__mappings__中的字段，支持m.key和m['key']两种访问方式，可以直接用在模板中。
+    """
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        # 只有slot没有赋值(字段没有加载)时才会调用__getattr__
+        model = self.__model__
+        pk = model.__primary_key__.name
+        if key in self.__slots__ and key != pk:
+            try:
+                value = _load_column(model, getattr(self, pk), key, self._shard())
+            except KeyError:
+                pass
+            else:
+                object.__setattr__(self, key, value)
+                return value
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is read-only.' % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _shard(self):
+        key = self.__model__.__shard_key__
+        return getattr(self, key) if key else None
+
+    def _loaded(self, key):
+        # 直接读取slot的描述符，不触发延迟加载
+        try:
+            getattr(self.__class__, key).__get__(self)
+        except AttributeError:
+            return False
+        return True
+
+    def __contains__(self, key):
+        return key in self.__slots__ and self._loaded(key)
+
+    def keys(self):
+        return [k for k in self.__slots__ if self._loaded(k)]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__ if self._loaded(k)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self.items()))
+
 class ModelMetaclass(type):
     """
     元类(最重要的部分！！！)
@@ -182,6 +589,7 @@ class ModelMetaclass(type):
         logging.info('Scan ORMapping %s...' % name)
         mappings = dict()  # 存储表字段与Field的映射关系。
         primary_key = None  # 存储表的主键字段，Field类型。
+        version = None  # 存储表的版本号字段，VersionField类型。
         for k, v in attrs.iteritems():
             if isinstance(v, Field):
                 if not v.name:
@@ -197,7 +605,14 @@ class ModelMetaclass(type):
                     if v.nullable:
                         logging.warning('NOTE: change primary key to non-nullable.')
                         v.nullable = False
+                    if v.deferred:
+                        logging.warning('NOTE: change primary key to non-deferred.')
+                        v.deferred = False
                     primary_key = v
+                if isinstance(v, VersionField):
+                    if version:
+                        raise TypeError('Cannot define more than 1 version field in class: %s' % name)
+                    version = v
                 mappings[k] = v
 
         # 检查是否存在主键：
@@ -215,12 +630,30 @@ class ModelMetaclass(type):
         # 为attrs添加特殊属性
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__version__'] = version
+        if attrs.get('__cache__'):
+            attrs['__cache__'] = _ModelCache(attrs['__table__'], attrs['__cache__'])
+        shard_key = attrs.get('__shard_key__')
+        if shard_key:
+            if shard_key not in mappings:
+                raise TypeError('Unknown shard key "%s" in class: %s' % (shard_key, name))
+            # 分片键用于路由，不能延迟加载
+            mappings[shard_key].deferred = False
+        # 默认加载的字段(不包括延迟加载的字段)，按字段定义顺序排列
+        attrs['__select__'] = ','.join(['`%s`' % f.name for f in sorted(mappings.values(), key=lambda f: f._order) if not f.deferred])
+        attrs['__indexes__'] = _gen_indexes(name, mappings, attrs.get('__indexes__', ()))
+        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, attrs['__indexes__'])
         for trigger in _triggers:
             if trigger not in attrs:
                 attrs[trigger] = None
+        # 计数缓存由insert()/upsert()/delete()按实际插入、删除的记录数维护
+        if attrs.get('__counter_cache__'):
+            attrs['__counter_cache__'] = _gen_counter_cache(name, mappings, attrs['__counter_cache__'])
 
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        # 生成对应的只读类
+        model.__readonly__ = type('ReadOnly%s' % name, (ReadOnlyModel,), dict(__slots__=tuple(mappings.iterkeys()), __model__=model))
+        return model
 
 class Model(dict):
     """
@@ -254,6 +687,19 @@ class Model(dict):
     >>> g = User.find_by_pk(10190)
     >>> g.email
     u'orm@db.org'
+    >>> User.where(email='orm@db.org').order_by('-last_modified').first().name
+    u'Michael'
+    >>> User.where(id__in=[10190, 10191]).count()
+    1
+    >>> User.where('last_modified>?', time.time()).exists()
+    False
+    >>> h = User.find_first('where id=?', 10190, columns=['name'])
+    >>> 'email' in h
+    False
+    >>> h.email
+    u'orm@db.org'
+    >>> hasattr(User(id=10190), 'email')
+    False
     >>> r = g.delete()
     >>> len(db.select('select * from user where id=10190'))
     0
@@ -269,9 +715,15 @@ class Model(dict):
     );
     """
     __metaclass__ = ModelMetaclass
-
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw);
+    __cache__ = None  # 主键缓存，默认不开启
+    __version__ = None  # 版本号字段，定义了VersionField时update()使用乐观锁
+    __shard_key__ = None  # 分片键的字段名
+    __shards__ = None  # 分片路由ShardRouter，为None时不分片
+    # 计数缓存：[(外键字段名, 父Model, 父Model中的计数字段名), ...]
+    # 父Model与子Model在同一个数据库时，计数与插入、删除在同一个事务中；
+    # 在不同的数据库(分片)时，计数在子Model的事务提交之后单独累加，两者之间进程退出或者累加失败会使计数不准确，
+    # 需要用rebuild_counters.py重新统计
+    __counter_cache__ = ()
 
     def __getattr__(self, key):
         try:
@@ -282,46 +734,291 @@ class Model(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __missing__(self, key):
+        """
+        访问尚未加载的字段(延迟加载的字段或者投影查询未选中的字段)时，按主键从数据库中单独加载该字段。
+        只有从数据库加载时没有选中的字段(_unloaded)才会延迟加载，其他不存在的key直接抛出KeyError。
+        """
+        if key not in self.__dict__.get('_unloaded', ()):
+            raise KeyError(key)
+        pk = self.__primary_key__.name
+        shard = dict.get(self, self.__shard_key__) if self.__shard_key__ else None
+        value = self[key] = _load_column(self.__class__, self[pk], key, shard)
+        return value
+
     @classmethod
-    def find_by_pk(cls, pk):
+    def _on_shards(cls, shard, fn, *args):
+        """
+        执行数据库操作fn：没有分片时直接执行；给出分片键的值时只在对应的分片上执行；
+        否则在所有分片上并行执行。分片之间不支持事务。
+        :param shard: 分片键的值
+        :return: 结果list，每个分片一个结果
+        """
+        router = cls.__shards__
+        if router is None:
+            return [fn(*args)]
+        if shard is not None:
+            with db.using(router.engine_for(shard)):
+                return [fn(*args)]
+        return _fan_out(router.engines, fn, *args)
+
+    @classmethod
+    def _find(cls, sql, args, kw):
+        """
+        在分片上查询并合并结果
+        :param kw: shard=分片键的值，order_by='-id'(合并各分片结果时的排序)，limit=合并后的最大条数，readonly
+        """
+        results = cls._on_shards(kw.get('shard'), db.select_rows, sql, *args)
+        readonly = kw.get('readonly', False)
+        limit = kw.get('limit')
+        # 每个分片只需要构造前limit条记录
+        return _merge([cls._from_rows(names, rows if limit is None else rows[:limit], readonly) for names, rows in results], _parse_order(kw.get('order_by')), None, limit)
+
+    @classmethod
+    def _select_columns(cls, columns):
+        """
+        生成select语句中的字段列表
+        :param columns: 需要加载的字段名list，为None时加载所有非延迟加载的字段
+        :return: 类似于 `id`,`name` 的字符串
+        """
+        if columns is None:
+            return cls.__select__
+        pk = cls.__primary_key__.name
+        L = [pk]
+        if cls.__version__:
+            # 乐观锁需要的是加载时的版本号，不能延迟加载
+            L.append(cls.__version__.name)
+        if cls.__shard_key__ and cls.__shard_key__ not in L:
+            L.append(cls.__shard_key__)
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError('Unknown column "%s" in class: %s' % (c, cls.__name__))
+            if c not in L:
+                L.append(c)
+        return ','.join(['`%s`' % c for c in L])
+
+    @classmethod
+    def _from_rows(cls, names, rows, readonly=False):
+        """
+        直接由数据库返回的tuple构造Model类型的对象，不再生成中间的Dict，
+        同时对声明了coerce的字段做类型转换。
+        :param names: 字段名list，与每条记录中值的顺序一致
+        :param rows: 数据库返回的记录list
+        :param readonly: 是否构造只读的对象(cls.__readonly__)
+        :return: list(Model)集合
+        """
+        mappings = cls.__mappings__
+        coercers = [(i, mappings[n].coerce) for i, n in enumerate(names) if n in mappings and mappings[n].coerce]
+        izip = itertools.izip
+        if readonly:
+            return cls._from_rows_readonly(names, rows, coercers)
+        if not coercers:
+            L = [cls(izip(names, row)) for row in rows]
+        else:
+            L = []
+            for row in rows:
+                row = list(row)
+                for i, coerce in coercers:
+                    if row[i] is not None:
+                        row[i] = coerce(row[i])
+                L.append(cls(izip(names, row)))
+        # 记录没有选中的字段以便延迟加载，同一次查询的对象共用一个frozenset：
+        unloaded = frozenset(mappings).difference(names)
+        if unloaded:
+            for m in L:
+                m.__dict__['_unloaded'] = unloaded
+        return L
+
+    @classmethod
+    def _from_rows_readonly(cls, names, rows, coercers):
+        ro = cls.__readonly__
+        new = object.__new__
+        # 直接使用slot的描述符赋值，跳过只读类的__setattr__
+        setters = [getattr(ro, str(n)).__set__ for n in names]
+        izip = itertools.izip
+        L = []
+        for row in rows:
+            if coercers:
+                row = list(row)
+                for i, coerce in coercers:
+                    if row[i] is not None:
+                        row[i] = coerce(row[i])
+            m = new(ro)
+            for setter, v in izip(setters, row):
+                setter(m, v)
+            L.append(m)
+        return L
+
+    @classmethod
+    def _from_db(cls, d, readonly=False):
+        """
+        通过dict(例如缓存中的记录)构造Model类型的对象
+        """
+        return cls._from_rows(d.keys(), [d.values()], readonly)[0]
+
+    @classmethod
+    def find_by_pk(cls, pk, columns=None, readonly=False, shard=None):
         """
         通过主键查找
         :param pk: 主键值
+        :param columns: 需要加载的字段名list，默认加载所有非延迟加载的字段
+        :param readonly: 是否返回只读的对象
+        :param shard: 分片键的值，分片键不是主键且没有给出时在所有分片上查找
         :return: Model类型的对象或者None
         """
-        d = db.select_one('select * from `%s` where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        cache = cls.__cache__ if columns is None else None
+        if cache:
+            d = cache.get(pk)
+            if d is not None:
+                return cls._from_db(d, readonly)
+        if shard is None and cls.__shard_key__ == cls.__primary_key__.name:
+            shard = pk
+        results = cls._on_shards(shard, db.select_rows, 'select %s from `%s` where `%s`=?' % (cls._select_columns(columns), cls.__table__, cls.__primary_key__.name), pk)
+        results = [(names, rows) for names, rows in results if rows]
+        if not results:
+            return None
+        names, rows = results[0]
+        if cache:
+            cache.set(pk, dict(itertools.izip(names, rows[0])))
+        return cls._from_rows(names, rows[:1], readonly)[0]
 
     @classmethod
-    def find_first(cls, where, *args):
+    def load_unloaded(cls, objs, batch_size=500):
+        """
+        批量加载多个对象没有加载的字段(延迟加载的字段或者投影查询未选中的字段)，
+        每batch_size个主键一次查询，避免逐个对象、逐个字段的延迟加载(如序列化为JSON时)。
+        :param objs: cls或cls.__readonly__的对象list
+        """
+        pk = cls.__primary_key__.name
+        groups = dict()
+        for m in objs:
+            if isinstance(m, ReadOnlyModel):
+                missing = [k for k in m.__slots__ if not m._loaded(k)]
+            else:
+                missing = [k for k in m.__dict__.get('_unloaded', ()) if k not in m]
+            if missing:
+                groups.setdefault(tuple(sorted(missing)), []).append(m)
+        for missing, L in groups.iteritems():
+            for i in xrange(0, len(L), batch_size):
+                chunk = dict([(m[pk], m) for m in L[i:i + batch_size]])
+                pks = chunk.keys()
+                for r in cls.find_by('where `%s` in (%s)' % (pk, ','.join(['?'] * len(pks))), *pks, columns=list(missing)):
+                    m = chunk.get(r[pk])
+                    if m is None:
+                        continue
+                    for k in missing:
+                        if isinstance(m, ReadOnlyModel):
+                            object.__setattr__(m, k, r[k])
+                        else:
+                            dict.__setitem__(m, k, r[k])
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        主键缓存的命中情况
+        :return: dict(hits=命中次数, misses=未命中次数, ratio=命中率)，未开启缓存时返回None
+        """
+        cache = cls.__cache__
+        if not cache:
+            return None
+        return dict(hits=cache.hits, misses=cache.misses, ratio=cache.hit_ratio)
+
+    def _evict(self):
+        """
+        从主键缓存中删除该对象：在事务中时等事务提交之后再删除，
+        否则提交之前并发的find_by_pk()会把旧的记录重新放入缓存
+        """
+        if self.__cache__:
+            db.after_commit(functools.partial(self.__cache__.delete, dict.get(self, self.__primary_key__.name)))
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
         """
         通过where clause和条件args查找，并返回一个Model类型的对象。
         如果查询结果有多个，则返回第一个。如果没有查询结果，则返回None。
         :param where: where clause条例
+        :param kw: columns=[...]，需要加载的字段名list，默认加载所有非延迟加载的字段；
+                   readonly=True，返回只读的对象；
+                   shard=分片键的值，没有给出时在所有分片上查找；order_by='-id'，合并各分片结果时的排序
         :return: Model类型的对象或者None
         """
-        d = db.select_one('select * from `%s` %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        kw['limit'] = 1
+        # 每个分片只需要返回一条记录：
+        sql = 'select %s from `%s` %s' % (cls._select_columns(kw.get('columns')), cls.__table__, _limit_one(where))
+        L = cls._find(sql, args, kw)
+        return L[0] if L else None
 
     @classmethod
-    def find_all(cls):
+    def find_all(cls, columns=None, readonly=False):
         """
         查找所有的记录
+        :param columns: 需要加载的字段名list，默认加载所有非延迟加载的字段
+        :param readonly: 是否返回只读的对象
         :return: list(Model)集合
         """
-        l = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in l]
+        return cls._find('select %s from `%s`' % (cls._select_columns(columns), cls.__table__), (), dict(readonly=readonly))
 
     @classmethod
-    def find_by(cls, where, *args):
+    def find_by(cls, where, *args, **kw):
         """
         通过where clause和条件args查找,返回list(Model)集合
         :param where: where clause条例
         :param args: 查询条件
+        :param kw: columns=[...]，需要加载的字段名list，默认加载所有非延迟加载的字段；
+                   readonly=True，返回只读的对象；
+                   shard=分片键的值，没有给出时在所有分片上并行查找并合并结果；
+                   order_by='-id'，合并各分片结果时的排序；limit=合并后的最大条数
         :return: list(Model)集合
         """
-        l = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in l]
+        return cls._find('select %s from `%s` %s' % (cls._select_columns(kw.get('columns')), cls.__table__, where), args, kw)
+
+    @classmethod
+    def update_where(cls, where, args, **values):
+        """
+        按条件批量修改记录，不需要先加载对象：
+        Blog.update_where('where user_id=?', [user.id], user_name=user.name)
+        :param where: where clause条例
+        :param args: where clause中?的参数
+        :param values: 需要修改的字段和值
+        :return: 修改的记录数
+        """
+        if not values:
+            raise ValueError('No column to update in class: %s' % cls.__name__)
+        L = []
+        params = []
+        for k, v in values.iteritems():
+            f = cls.__mappings__.get(k)
+            if f is None:
+                raise ValueError('Unknown column "%s" in class: %s' % (k, cls.__name__))
+            if not f.updatable or f is cls.__version__:
+                raise ValueError('Column "%s" is not updatable in class: %s' % (k, cls.__name__))
+            L.append('`%s`=?' % f.name)
+            params.append(v)
+        if cls.__version__:
+            L.append('`%s`=`%s`+1' % (cls.__version__.name, cls.__version__.name))
+        params.extend(args)
+        sql = 'update `%s` set %s %s' % (cls.__table__, ','.join(L), where)
+        def _update():
+            if not cls.__cache__:
+                return db.update(sql, *params)
+            # 开启了主键缓存时，先找出受影响的主键，在事务提交之后再清除缓存，
+            # 否则提交之前并发的读取会把旧的记录重新放入缓存
+            with db.transaction():
+                pk = cls.__primary_key__.name
+                pks = [d[pk] for d in db.select('select `%s` from `%s` %s' % (pk, cls.__table__, where), *args)]
+                r = db.update(sql, *params)
+                for k in pks:
+                    db.after_commit(functools.partial(cls.__cache__.delete, k))
+                return r
+        return sum(cls._on_shards(None, _update))
+
+    @classmethod
+    def where(cls, *clauses, **kw):
+        """
+        创建一个查询构造器，参数同Query.where()
+        :return: Query对象
+        """
+        return Query(cls).where(*clauses, **kw)
 
     @classmethod
     def count_all(cls):
@@ -329,53 +1026,665 @@ class Model(dict):
         Find by 'select count(pk) from table' and return integer.
         :return: integer
         """
-        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+        return sum(cls._on_shards(None, db.select_int, 'select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__)))
 
     @classmethod
-    def count_by(cls, where, *args):
+    def count_by(cls, where, *args, **kw):
         """
         Find by 'select count(pk) from table where ... ' and return integer.
         :param where: where clause条例
         :param args: 查询条件
+        :param kw: shard=分片键的值，没有给出时在所有分片上并行统计并求和
         :return: integer
         """
-        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        return sum(cls._on_shards(kw.get('shard'), db.select_int, 'select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args))
 
+    @_sharded
     def update(self):
         self.pre_update and self.pre_update()
         L = []
         args = []
+        version = self.__version__
         for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
+            if v.updatable and v is not version:
+                # 没有加载的字段不做修改
+                if k not in self:
+                    continue
+                arg = self[k]
                 L.append('`%s`=?' % k)
                 args.append(arg)
         pk = self.__primary_key__.name
         args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        if version:
+            # 乐观锁：只有版本号没有被修改时才更新，同时版本号加1
+            L.append('`%s`=`%s`+1' % (version.name, version.name))
+            args.append(self[version.name])
+            r = db.update('update `%s` set %s where `%s`=? and `%s`=?' % (self.__table__, ','.join(L), pk, version.name), *args)
+            if r == 0:
+                self._evict()
+                raise ConflictError('Record %s of %s has been modified or deleted (version %s).' % (self[pk], self.__class__.__name__, self[version.name]))
+            self[version.name] = self[version.name] + 1
+        elif L:
+            db.update('update `%s` set %s where `%s`=?' % (self.__table__, ','.join(L), pk), *args)
+        self._evict()
         return self
 
+    @_sharded
+    @_with_counter_cache
     def delete(self):
         self.pre_delete and self.pre_delete()
         pk = self.__primary_key__.name
         args = (getattr(self, pk),)
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        r = db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        if r == 1 and self.__counter_cache__:
+            # 只有确实删除了记录才减少计数(重复删除时不会减成负数)
+            self._update_counters(-1)
+        self._evict()
 
+    @_sharded
+    @_with_counter_cache
     def insert(self):
         self.pre_insert and self.pre_insert()
         params = {}
         for k, v in self.__mappings__.iteritems():
             if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
+                if k not in self:
+                    self[k] = v.default
+                params[v.name] = self[k]
         db.insert(self.__table__, **params)
+        if self.__counter_cache__:
+            self._update_counters(1)
         return self
 
+    @_sharded
+    @_with_counter_cache
+    def upsert(self):
+        """
+        插入一条记录，如果主键(或唯一索引)已存在则更新可修改的字段，只需要一次数据库操作：
+        insert into ... on duplicate key update ...
+        """
+        self.pre_insert and self.pre_insert()
+        cols = []
+        args = []
+        updates = []
+        for k, v in self.__mappings__.iteritems():
+            if v.insertable:
+                if k not in self:
+                    self[k] = v.default
+                cols.append('`%s`' % v.name)
+                args.append(self[k])
+                if v is self.__version__:
+                    updates.append('`%s`=`%s`+1' % (v.name, v.name))
+                elif v.updatable:
+                    updates.append('`%s`=values(`%s`)' % (v.name, v.name))
+        pk = self.__primary_key__.name
+        if not updates:
+            # 没有可修改的字段时，主键已存在则什么也不做
+            updates.append('`%s`=`%s`' % (pk, pk))
+        r = db.update('insert into `%s` (%s) values (%s) on duplicate key update %s' % (self.__table__, ','.join(cols), ','.join(['?'] * len(cols)), ','.join(updates)), *args)
+        if r == 1 and self.__counter_cache__:
+            # 影响的记录数为1时插入了新记录，为2(修改)或0(没有变化)时记录已存在
+            self._update_counters(1)
+        if r == 2 and self.__version__:
+            # 修改了已存在的记录，数据库中的版本号已经加1，重新读取版本号，之后的update()才不会冲突
+            version = self.__version__.name
+            d = db.select_one('select `%s` from `%s` where `%s`=?' % (version, self.__table__, pk), self[pk])
+            if d is not None:
+                self[version] = d[version]
+        self._evict()
+        return self
+
+    def _update_counters(self, delta):
+        """
+        累加父Model中的计数字段，事务提交后清除父Model的主键缓存。
+        父Model在另一个数据库(分片)时不能与子Model在同一个事务中，在子Model的事务提交之后再累加。
+        """
+        for fk, parent, column in self.__counter_cache__:
+            value = self[fk]
+            engine = _counter_engine(self, parent, value)
+            if engine is None:
+                _incr_counter(parent, column, value, delta)
+            else:
+                db.after_commit(functools.partial(_incr_counter, parent, column, value, delta, engine))
+
+    @classmethod
+    def rebuild_counters(cls):
+        """
+        重新统计所有父Model中的计数字段，每个计数字段只需要一条sql语句。
+        父Model开启了主键缓存时，缓存中的旧计数在ttl之后过期。
+        :return: 修改的记录数
+        """
+        if cls.__shards__ is not None or any(parent.__shards__ is not None for fk, parent, column in cls.__counter_cache__):
+            raise ValueError('Can not rebuild counters across shards in class: %s' % cls.__name__)
+        n = 0
+        for fk, parent, column in cls.__counter_cache__:
+            pk = parent.__primary_key__.name
+            n = n + db.update('update `%s` p left join (select `%s` as fk, count(*) as n from `%s` group by `%s`) c on c.fk=p.`%s` set p.`%s`=coalesce(c.n, 0)' % (parent.__table__, fk, cls.__table__, fk, pk, column))
+        return n
+
+def schema_diff(model):
+    """
+    对比Model的定义和数据库中information_schema里的表结构，生成同步表结构需要执行的sql语句。
+    只添加缺少的字段和索引，数据库中多余的字段和索引以注释的形式列出，不会删除。
+    :param model: Model的子类
+    :return: sql语句list，表结构一致时返回空list
+    """
+    table = model.__table__
+    columns = db.select('select column_name as name from information_schema.columns where table_schema=database() and table_name=?', table)
+    if not columns:
+        # 去掉__sql__()开头的注释行，返回可以直接执行的create table语句
+        return ['\n'.join([line for line in model().__sql__().split('\n') if not line.startswith('--')])]
+    existing = set([c.name for c in columns])
+    rows = db.select('select index_name as name, column_name as col, non_unique from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', table)
+    current = collections.OrderedDict()
+    for r in rows:
+        if r.name == 'PRIMARY':
+            continue
+        current.setdefault(r.name, ([], not r.non_unique))[0].append(r.col)
+    current_shapes = set([(tuple(cols), unique) for cols, unique in current.itervalues()])
+    wanted_shapes = set()
+    dropped = set()
+    L = []
+    sql = []
+    for f in sorted(model.__mappings__.values(), key=lambda f: f._order):
+        if f.name not in existing:
+            L.append('add column `%s` %s%s' % (f.name, f.ddl, '' if f.nullable else ' not null'))
+    for index in model.__indexes__:
+        name, cols, unique = index
+        wanted_shapes.add((cols, unique))
+        if (cols, unique) not in current_shapes:
+            if name in current:
+                dropped.add(name)
+                L.append('drop key `%s`' % name)
+            L.append('add %s' % _gen_index_sql(index))
+    if L:
+        # 合并成一条alter table语句，MySQL只需要重建一次表
+        sql.append('alter table `%s`\n  %s;' % (table, ',\n  '.join(L)))
+    for name, (cols, unique) in current.iteritems():
+        if name not in dropped and (tuple(cols), unique) not in wanted_shapes:
+            sql.append('-- %s: index `%s` (%s) is not declared in %s' % (table, name, ','.join(cols), model.__name__))
+    return sql
+
+# 查询构造器支持的比较操作符，如 created_at__gt=t 生成 `created_at`>?
+_QUERY_OPERATORS = {
+    'eq': '=',
+    'ne': '<>',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+    'like': ' like ',
+    'in': ' in ',
+}
+
+# 已编译的sql语句缓存，key是查询的形状(shape)，value是sql字符串
+_query_cache = {}
+_QUERY_CACHE_SIZE = 1024  # 缓存的最大条数，超过时清空(in条件的参数个数不同会产生不同的形状)
+
+class Query(object):
+    """
+    可组合的查询构造器，由Model.where()创建，每次调用都返回一个新的Query对象：
+
+        users = User.where(admin=True).order_by('-created_at').limit(10).all()
+
+    查询条件只决定sql的形状，具体的值都以?占位符传入db.select()，
+    所以相同形状的查询只编译一次sql语句。
+    """
+    def __init__(self, model):
+        self._model = model
+        self._where = ()    # 查询条件的形状：('raw', where_sql) 或 (字段名, 操作符, 参数个数)
+        self._args = ()     # 查询条件对应的参数
+        self._order = ()    # 排序：(字段名, 是否降序)
+        self._limit = None
+        self._offset = None
+        self._columns = None
+        self._readonly = False
+        self._shard = None  # 查询条件中分片键的值，用于路由到单个分片
+
+    def _copy(self, **kw):
+        q = Query(self._model)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(kw)
+        return q
+
+    def _check_column(self, name):
+        if name not in self._model.__mappings__:
+            raise ValueError('Unknown column "%s" in class: %s' % (name, self._model.__name__))
+
+    def where(self, *clauses, **kw):
+        """
+        添加查询条件，多个条件之间用and连接。
+        :param clauses: 可选的原始where子句及其参数，如 where('created_at>?', t)
+        :param kw: 字段条件，如 email='a@b.c'，created_at__gt=t，id__in=[...]，值为None时生成is null
+        :return: 新的Query对象
+        """
+        shapes = list(self._where)
+        args = list(self._args)
+        shard = self._shard
+        if clauses:
+            shapes.append(('raw', clauses[0]))
+            args.extend(clauses[1:])
+        for k in sorted(kw.iterkeys()):
+            v = kw[k]
+            name, op = k, 'eq'
+            if '__' in k:
+                name, op = k.rsplit('__', 1)
+                if op not in _QUERY_OPERATORS:
+                    raise ValueError('Unknown operator "%s" in query: %s' % (op, k))
+            self._check_column(name)
+            if op == 'in':
+                v = list(v)
+                shapes.append((name, op, len(v)))
+                args.extend(v)
+            elif v is None and op in ('eq', 'ne'):
+                shapes.append((name, op, 0))
+            else:
+                shapes.append((name, op, 1))
+                args.append(v)
+                if op == 'eq' and name == self._model.__shard_key__:
+                    shard = v
+        return self._copy(_where=tuple(shapes), _args=tuple(args), _shard=shard)
+
+    def order_by(self, *fields):
+        """
+        添加排序字段，字段名前加'-'表示降序，如 order_by('-created_at')。
+        """
+        order = list(self._order)
+        for f in fields:
+            desc = f.startswith('-')
+            name = f[1:] if desc else f
+            self._check_column(name)
+            order.append((name, desc))
+        return self._copy(_order=tuple(order))
+
+    def limit(self, limit, offset=None):
+        return self._copy(_limit=limit, _offset=offset)
+
+    def offset(self, offset):
+        return self._copy(_offset=offset)
+
+    def columns(self, *columns):
+        """
+        只加载指定的字段，其余字段在第一次访问时延迟加载。
+        """
+        for c in columns:
+            self._check_column(c)
+        return self._copy(_columns=columns)
+
+    def readonly(self):
+        """
+        返回只读的对象(Model.__readonly__)，占用更少的内存。
+        """
+        return self._copy(_readonly=True)
+
+    def _sql(self, kind):
+        """
+        根据查询的形状从缓存中取出sql语句，缓存中没有时再编译。
+        :param kind: 'select'，'count'或者'exists'
+        :return: (sql, args)
+        """
+        model = self._model
+        has_limit = kind == 'select' and self._limit is not None
+        has_offset = kind == 'select' and self._offset is not None
+        shape = (model, kind, self._where, self._order if kind == 'select' else (), has_limit, has_offset, self._columns if kind == 'select' else None)
+        sql = _query_cache.get(shape)
+        if sql is None:
+            if len(_query_cache) >= _QUERY_CACHE_SIZE:
+                _query_cache.clear()
+            sql = _query_cache[shape] = _compile_query(shape)
+        args = list(self._args)
+        if has_limit:
+            args.append(self._limit)
+        if has_offset:
+            args.append(self._offset)
+        return sql, args
+
+    def _fan_out(self):
+        """
+        是否需要在所有分片上查询
+        """
+        return self._model.__shards__ is not None and self._shard is None
+
+    def all(self):
+        """
+        :return: list(Model)集合
+        """
+        model = self._model
+        if not self._fan_out():
+            sql, args = self._sql('select')
+            names, rows = model._on_shards(self._shard, db.select_rows, sql, *args)[0]
+            return model._from_rows(names, rows, self._readonly)
+        # 每个分片取前offset+limit条记录，合并排序后再截取
+        q = self._copy(_limit=None if self._limit is None else (self._offset or 0) + self._limit, _offset=None)
+        sql, args = q._sql('select')
+        results = model._on_shards(None, db.select_rows, sql, *args)
+        return _merge([model._from_rows(names, rows, self._readonly) for names, rows in results], self._order, self._offset, self._limit)
+
+    def first(self):
+        """
+        :return: 第一个Model类型的对象或者None
+        """
+        L = self._copy(_limit=1).all()
+        return L[0] if L else None
+
+    def iterate(self, batch_size=1000):
+        """
+        分批查询并逐个返回Model类型的对象，每批最多加载batch_size条记录。
+        """
+        offset = self._offset or 0
+        remain = self._limit
+        while remain is None or remain > 0:
+            size = batch_size if remain is None else min(batch_size, remain)
+            L = self._copy(_limit=size, _offset=offset).all()
+            for m in L:
+                yield m
+            if len(L) < size:
+                break
+            offset = offset + size
+            if remain is not None:
+                remain = remain - size
+
+    def __iter__(self):
+        return self.iterate()
+
+    def count(self):
+        """
+        :return: 符合条件的记录数
+        """
+        sql, args = self._sql('count')
+        return sum(self._model._on_shards(self._shard, db.select_int, sql, *args))
+
+    def exists(self):
+        """
+        :return: 是否存在符合条件的记录
+        """
+        sql, args = self._sql('exists')
+        return any([d is not None for d in self._model._on_shards(self._shard, db.select_one, sql, *args)])
+
+def _compile_query(shape):
+    """
+    把查询的形状编译成sql语句，参数都用?代替。
+    """
+    model, kind, where, order, has_limit, has_offset, columns = shape
+    table = model.__table__
+    if kind == 'count':
+        sql = ['select count(`%s`) from `%s`' % (model.__primary_key__.name, table)]
+    elif kind == 'exists':
+        sql = ['select 1 from `%s`' % table]
+    else:
+        sql = ['select %s from `%s`' % (model._select_columns(columns), table)]
+    L = []
+    for w in where:
+        if w[0] == 'raw':
+            L.append('(%s)' % w[1])
+            continue
+        name, op, n = w
+        if op == 'in':
+            L.append('`%s` in (%s)' % (name, ','.join(['?'] * n)) if n else '1=0')
+        elif n == 0:
+            L.append('`%s` is %snull' % (name, 'not ' if op == 'ne' else ''))
+        else:
+            L.append('`%s`%s?' % (name, _QUERY_OPERATORS[op]))
+    if L:
+        sql.append('where %s' % ' and '.join(L))
+    if order:
+        sql.append('order by %s' % ','.join(['`%s`%s' % (name, ' desc' if desc else '') for name, desc in order]))
+    if has_limit:
+        sql.append('limit ?')
+    elif has_offset:
+        sql.append('limit 18446744073709551615')  # MySQL不支持单独使用offset
+    if has_offset:
+        sql.append('offset ?')
+    if kind == 'exists':
+        sql.append('limit 1')
+    sql = ' '.join(sql)
+    logging.info('Compile query: %s' % sql)
+    return sql
+
+######################延迟写入(write-behind)######################
+class WriteBehindBuffer(object):
+    """
+    延迟写入的缓冲区，用于访问量、动态等高频的计数和只追加的插入：
+
+        buf = WriteBehindBuffer(max_size=1000, interval=5)
+        buf.insert(Event(blog_id=blog.id, kind='view'))
+        buf.incr(Blog, blog.id, 'views')
+
+    插入和计数先放在内存中，同一条记录同一字段的计数会合并成一次累加；
+    后台线程在缓冲的条数达到max_size或者每隔interval秒时批量写入数据库，
+    close()(以及进程退出时)会把剩余的数据全部写入。
+
+    插入按batch_size条分成多条insert语句(不超过max_allowed_packet)，写入失败的批次单独重试，
+    不影响其他批次；失败max_retries次之后逐条插入，仍然失败的记录(如主键重复)写入错误日志后丢弃。
+    缓冲的条数超过max_pending时(数据库长时间不可用)丢弃新的写入并记录错误日志。
+    """
+    def __init__(self, max_size=1000, interval=5.0, batch_size=500, max_retries=3, max_pending=100000):
+        self._max_size = max_size
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_retries = max_retries
+        self._max_pending = max_pending
+        self._cond = threading.Condition()
+        self._inserts = collections.OrderedDict()   # (model, shard) => [row tuple, ...]
+        self._failed = []  # 写入失败的批次：[(model, shard, rows, 失败次数), ...]
+        self._counters = collections.OrderedDict()  # (model, 分片编号, pk, column) => 累加值
+        self._closed = False
+        self._flush_lock = threading.Lock()
+        self.flushed_inserts = 0
+        self.flushed_counters = 0
+        self.errors = 0
+        self.dropped = 0
+        self.last_flush = None
+        self._thread = threading.Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _pending_inserts(self):
+        return sum([len(L) for L in self._inserts.itervalues()]) + sum([len(t[2]) for t in self._failed])
+
+    def _pending(self):
+        return self._pending_inserts() + len(self._counters)
+
+    def _check_full(self, what):
+        """
+        缓冲区已满时丢弃这次写入
+        :return: 是否已满
+        """
+        if self._pending() < self._max_pending:
+            return False
+        self.dropped = self.dropped + 1
+        logging.error('write-behind: buffer is full (%d pending), %s dropped.' % (self._max_pending, what))
+        return True
+
+    def insert(self, m):
+        """
+        缓冲一个Model对象的插入，与Model.insert()一样会调用pre_insert并填充默认值。
+        声明了__counter_cache__时，父Model中的计数也通过incr()缓冲，在插入之后写入。
+        """
+        m.pre_insert and m.pre_insert()
+        for k, v in m.__mappings__.iteritems():
+            if v.insertable and k not in m:
+                m[k] = v.default
+        shard = m[m.__shard_key__] if m.__shard_key__ else None
+        row = tuple([m[k] for k in _insert_columns(m.__class__)])
+        with self._cond:
+            self._check_open()
+            if self._check_full('insert into %s' % m.__table__):
+                return m
+            self._inserts.setdefault((m.__class__, _shard_index(m.__class__, shard)), []).append(row)
+            for fk, parent, column in m.__counter_cache__:
+                if m[fk] is not None:
+                    self.incr(parent, m[fk], column)
+            self._notify()
+        return m
+
+    def incr(self, model, pk, column, n=1, shard=None):
+        """
+        缓冲一次计数：update table set column=column+n where pk=?
+        :param shard: 分片键的值，分片键不是主键时必须给出
+        """
+        if column not in model.__mappings__:
+            raise ValueError('Unknown column "%s" in class: %s' % (column, model.__name__))
+        if shard is None and model.__shard_key__ == model.__primary_key__.name:
+            shard = pk
+        key = (model, _shard_index(model, shard), pk, column)
+        with self._cond:
+            self._check_open()
+            if key not in self._counters and self._check_full('counter %s.%s' % (model.__name__, column)):
+                return
+            self._counters[key] = self._counters.get(key, 0) + n
+            self._notify()
+
+    def _check_open(self):
+        if self._closed:
+            raise db.DBError('WriteBehindBuffer is closed.')
+
+    def _notify(self):
+        if self._pending() >= self._max_size:
+            self._cond.notify()
+
+    def stats(self):
+        """
+        :return: dict(pending_inserts=, pending_counters=, flushed_inserts=, flushed_counters=, errors=, dropped=, last_flush=)
+        """
+        with self._cond:
+            return dict(
+                pending_inserts=self._pending_inserts(),
+                pending_counters=len(self._counters),
+                flushed_inserts=self.flushed_inserts,
+                flushed_counters=self.flushed_counters,
+                errors=self.errors,
+                dropped=self.dropped,
+                last_flush=self.last_flush)
+
+    def _run(self):
+        errors = self.errors
+        while True:
+            with self._cond:
+                # 上次写入失败时等待interval秒再重试，不连续重试
+                if not self._closed and (self._pending() < self._max_size or self.errors != errors):
+                    errors = self.errors
+                    self._cond.wait(self._interval)
+                if self._closed:
+                    return
+                if not self._pending():
+                    continue
+            self.flush()
+
+    def flush(self):
+        """
+        把缓冲区中的数据批量写入数据库：每个表(分片)每batch_size条一条多行insert语句，计数在一个事务中累加。
+        """
+        with self._flush_lock:
+            with self._cond:
+                inserts, self._inserts = self._inserts, collections.OrderedDict()
+                failed, self._failed = self._failed, []
+                counters, self._counters = self._counters, collections.OrderedDict()
+            batches = list(failed)
+            for (model, shard), rows in inserts.iteritems():
+                for i in xrange(0, len(rows), self._batch_size):
+                    batches.append((model, shard, rows[i:i + self._batch_size], 0))
+            for model, shard, rows, failures in batches:
+                if failures >= self._max_retries:
+                    self._insert_rows(model, shard, rows)
+                    continue
+                try:
+                    with _shard_engine(model, shard):
+                        db.insert_many(model.__table__, _insert_names(model), rows)
+                    self.flushed_inserts = self.flushed_inserts + len(rows)
+                except Exception:
+                    logging.exception('write-behind: insert %d rows into %s failed.' % (len(rows), model.__table__))
+                    self.errors = self.errors + 1
+                    with self._cond:
+                        self._failed.append((model, shard, rows, failures + 1))
+            groups = collections.OrderedDict()
+            for (model, index, pk, column), n in counters.iteritems():
+                groups.setdefault((model, index), []).append((pk, column, n))
+            for (model, index), L in groups.iteritems():
+                try:
+                    with _shard_engine(model, index):
+                        with db.transaction():
+                            for pk, column, n in L:
+                                db.update('update `%s` set `%s`=`%s`+? where `%s`=?' % (model.__table__, column, column, model.__primary_key__.name), n, pk)
+                    self.flushed_counters = self.flushed_counters + len(L)
+                    if model.__cache__:
+                        for pk, column, n in L:
+                            model.__cache__.delete(pk)
+                except Exception:
+                    logging.exception('write-behind: update %d counters of %s failed.' % (len(L), model.__table__))
+                    self.errors = self.errors + 1
+                    with self._cond:
+                        for pk, column, n in L:
+                            key = (model, index, pk, column)
+                            self._counters[key] = self._counters.get(key, 0) + n
+            self.last_flush = time.time()
+
+    def _insert_rows(self, model, shard, rows):
+        """
+        多次失败的批次逐条插入，仍然失败的记录写入错误日志后丢弃
+        """
+        names = _insert_names(model)
+        for row in rows:
+            try:
+                with _shard_engine(model, shard):
+                    db.insert_many(model.__table__, names, [row])
+                self.flushed_inserts = self.flushed_inserts + 1
+            except Exception, e:
+                self.errors = self.errors + 1
+                self.dropped = self.dropped + 1
+                logging.error('write-behind: drop row of %s after %d retries: %s %r' % (model.__table__, self._max_retries, e, dict(zip(names, row))))
+
+    def close(self):
+        """
+        停止后台线程，并把剩余的数据写入数据库。
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        pending = self._pending()
+        if pending:
+            logging.error('write-behind: %d pending writes lost on close.' % pending)
+
+def _insert_columns(model):
+    """
+    可插入的字段，按字段定义顺序排列
+    """
+    return [k for k, v in sorted(model.__mappings__.items(), key=lambda kv: kv[1]._order) if v.insertable]
+
+def _insert_names(model):
+    return [model.__mappings__[k].name for k in _insert_columns(model)]
+
+def _shard_index(model, shard):
+    """
+    分片键的值对应的分片编号，没有分片时返回None
+    """
+    if model.__shards__ is None:
+        return None
+    if shard is None:
+        raise ValueError('Shard key value is required for sharded class: %s' % model.__name__)
+    return model.__shards__.shard_for(shard)
+
+class _NoShardCtx(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+def _shard_engine(model, index):
+    """
+    :param index: 分片编号，为None时使用全局的engine
+    """
+    if index is None:
+        return _NoShardCtx()
+    return db.using(model.__shards__.engines[index])
+##################################################################
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('root', '123456', 'awesome')
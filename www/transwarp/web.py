@@ -8,13 +8,28 @@ create time: 2017-09-15
 disc: A simple, lightweight, WSGI-compatible web framework.
 """
 
-import threading, datetime, re, urllib, os, mimetypes, cgi, logging, functools, types, sys, traceback
+import threading, datetime, re, urllib, os, mimetypes, cgi, logging, functools, types, sys, traceback, time, collections, hashlib, stat, zlib, mmap, json, shutil, gzip, tempfile, urlparse, decimal
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 优先使用更快的JSON模块：
+try:
+    import ujson as _fast_json
+except ImportError:
+    try:
+        import simplejson as _fast_json
+    except ImportError:
+        _fast_json = None
+
 # 全局 ThreadLocal 对象，用来存储request和response：
 ctx = threading.local()
 
@@ -335,6 +350,16 @@ def conflict():
     '''
     return HttpError(409)
 
+def methodnotallowed():
+    '''
+    Send a method not allowed response.
+    >>> raise methodnotallowed()
+    Traceback (most recent call last):
+      ...
+    HttpError: 405 Method Not Allowed
+    '''
+    return HttpError(405)
+
 def internalerror():
     '''
     Send an internal error response.
@@ -345,6 +370,16 @@ def internalerror():
     '''
     return HttpError(500)
 
+def notmodified():
+    '''
+    Send a not modified response without body.
+    >>> raise notmodified()
+    Traceback (most recent call last):
+      ...
+    HttpError: 304 Not Modified
+    '''
+    return HttpError(304)
+
 def redirect(location):
     '''
     Do permanent redirect.
@@ -429,7 +464,7 @@ def _unquote(s, encoding='utf-8'):
     return urllib.unquote(s).decode(encoding)
 #############################################################
 
-######################GET和POST的装饰器########################
+######################GET、POST、PUT和DELETE的装饰器########################
 def get(path):
     """
     A @get decorator.
@@ -474,6 +509,45 @@ def post(path):
         func.__web_method__ = 'POST'
         return func
     return _decorator
+
+def put(path):
+    '''
+    A @put decorator.
+    >>> @put('/api/blogs/:id')
+    ... def testput():
+    ...     return '200'
+    ...
+    >>> testput.__web_route__
+    '/api/blogs/:id'
+    >>> testput.__web_method__
+    'PUT'
+    '''
+    def _decorator(func):
+        func.__web_route__ = path
+        func.__web_method__ = 'PUT'
+        return func
+    return _decorator
+
+def delete(path):
+    '''
+    A @delete decorator.
+    >>> @delete('/api/blogs/:id')
+    ... def testdelete():
+    ...     return '200'
+    ...
+    >>> testdelete.__web_route__
+    '/api/blogs/:id'
+    >>> testdelete.__web_method__
+    'DELETE'
+    '''
+    def _decorator(func):
+        func.__web_route__ = path
+        func.__web_method__ = 'DELETE'
+        return func
+    return _decorator
+
+# 可以注册路由的method，HEAD和OPTIONS由WSGIApplication自动处理
+_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
 #############################################################
 
 ######################route(不太懂这块代码)####################
@@ -541,27 +615,565 @@ class Route(object):
         return 'Route(dynamic,%s,path=%s)' % (self.method, self.path)
 
     __repr__ = __str__
+
+class _TrieNode(object):
+    __slots__ = ('static', 'dynamic', 'route')
+
+    def __init__(self):
+        self.static = {}  # 不含变量的段 -> 子节点
+        self.dynamic = []  # [(含变量的段, 段的正则, 子节点), ...]
+        self.route = None  # (注册顺序, Route)
+
+class RouteTrie(object):
+    """
+    按'/'分段的前缀树，保存同一个method的所有动态路由。
+    变量只匹配[^/]+，不会跨段，因此匹配url只需要逐段查找，时间与url的段数有关，与路由的数量无关。
+    多个路由都能匹配时，与逐个匹配相同，先注册的路由优先。
+
+    >>> def f1(id): return 'f1 %s' % id
+    >>> def f2(id, pid): return 'f2 %s %s' % (id, pid)
+    >>> def f3(a, b): return 'f3 %s %s' % (a, b)
+    >>> f1.__web_route__, f2.__web_route__, f3.__web_route__ = '/blog/:id', '/blog/:id-:pid/edit', '/:a/:b'
+    >>> f1.__web_method__ = f2.__web_method__ = f3.__web_method__ = 'GET'
+    >>> trie = RouteTrie()
+    >>> for f in (f1, f2, f3): trie.add(Route(f))
+    >>> len(trie)
+    3
+    >>> route, args = trie.match('/blog/123')
+    >>> route(*args)
+    'f1 123'
+    >>> route, args = trie.match('/blog/1-2/edit')
+    >>> route(*args)
+    'f2 1 2'
+    >>> route, args = trie.match('/user/123')
+    >>> route(*args)
+    'f3 user 123'
+    >>> trie.match('/blog/1/2/3') is None
+    True
+    """
+    def __init__(self):
+        self._root = _TrieNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, route):
+        node = self._root
+        for seg in route.path.split('/'):
+            if _re_route.search(seg) is None:
+                child = node.static.get(seg)
+                if child is None:
+                    child = node.static[seg] = _TrieNode()
+            else:
+                for s, regex, child in node.dynamic:
+                    if s == seg:
+                        break
+                else:
+                    child = _TrieNode()
+                    node.dynamic.append((seg, re.compile(_build_regex(seg)), child))
+            node = child
+        if node.route is None:
+            node.route = (self._count, route)
+        self._count = self._count + 1
+
+    def match(self, url):
+        """
+        :return: (Route, 参数tuple)，没有匹配的路由时返回None
+        """
+        r = self._match(self._root, url.split('/'), 0, ())
+        if r is None:
+            return None
+        return r[1], r[2]
+
+    def _match(self, node, segs, i, args):
+        if i == len(segs):
+            if node.route is None:
+                return None
+            return node.route[0], node.route[1], args
+        best = None
+        child = node.static.get(segs[i])
+        if child is not None:
+            best = self._match(child, segs, i + 1, args)
+        for seg, regex, child in node.dynamic:
+            m = regex.match(segs[i])
+            if m:
+                r = self._match(child, segs, i + 1, args + m.groups())
+                if r is not None and (best is None or r[0] < best[0]):
+                    best = r
+        return best
 #############################################################
 
-def _static_file_generator(fpath):
+def _static_file_generator(fpath, start=0, length=None):
     """
     根据fpath路径读文件，一次读取8192bytes，并返回一个迭代对象。
+    :param start: 开始的位置
+    :param length: 读取的字节数，为None时读到文件末尾
     """
     BLOCK_SIZE = 8192
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
-            yield block
+        if start:
+            f.seek(start)
+        if length is None:
             block = f.read(BLOCK_SIZE)
+            while block:
+                yield block
+                block = f.read(BLOCK_SIZE)
+            return
+        while length > 0:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length = length - len(block)
+            yield block
 
-class StaticFileRoute(object):
+def _send_file(fpath):
+    """
+    返回整个文件，服务器提供wsgi.file_wrapper时使用它(可以使用sendfile)，否则在python中按块读取。
+    """
+    wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+    if wrapper is None:
+        return _static_file_generator(fpath)
+    return wrapper(open(fpath, 'rb'), 8192)
+
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(header, size):
+    """
+    解析只有一个范围的Range请求头，返回(start, end)，包括end。
+    请求头不存在或者不支持(多个范围)时返回None，范围超出文件时抛出416。
+
+    >>> _parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> _parse_range('bytes=900-', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=0-5000', 1000)
+    (0, 999)
+    >>> _parse_range('bytes=0-1,5-6', 1000) is None
+    True
+    """
+    if not header:
+        return None
+    m = _RE_RANGE.match(header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        if m.group(2) and int(m.group(2)) < start:
+            return None
+    else:
+        # bytes=-N：最后N个字节
+        start, end = max(size - int(m.group(2)), 0), size - 1
+    if start >= size or end < start:
+        ctx.response.set_header('Content-Range', 'bytes */%d' % size)
+        raise HttpError(416)
+    return start, end
+
+def _if_range(etag, last_modified):
+    """
+    If-Range与文件的强ETag或Last-Modified相同时，Range请求才有效
     """
+    if_range = ctx.request.header('If-Range')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    t = parsedate_tz(if_range)
+    return t is not None and mktime_tz(t) == int(last_modified)
+
+# 带指纹的文件名，如app.3f2a9c1d.css，内容改变时文件名也会改变，可以永久缓存
+_RE_FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.\w+$')
+
+######################条件请求(ETag/Last-Modified)######################
+def _etag(body):
+    """
+    根据编码后的body生成弱ETag
 
+    >>> _etag('hello')
+    'W/"5d41402abc4b2a76b9719d911017c592"'
     """
-    def __init__(self):
+    return 'W/"%s"' % hashlib.md5(body).hexdigest()
+
+def _etag_matches(etag, if_none_match):
+    """
+    按弱比较判断If-None-Match是否包含etag
+
+    >>> _etag_matches('W/"abc"', '"abc"')
+    True
+    >>> _etag_matches('W/"abc"', 'W/"xyz", W/"abc"')
+    True
+    >>> _etag_matches('W/"abc"', '*')
+    True
+    >>> _etag_matches('W/"abc"', '"xyz"')
+    False
+    """
+    if if_none_match.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def _check_not_modified(etag=None, last_modified=None):
+    """
+    设置响应的ETag和Last-Modified，请求的If-None-Match/If-Modified-Since说明客户端的缓存仍然有效时抛出304。
+    有If-None-Match时忽略If-Modified-Since。
+    :param etag: ETag
+    :param last_modified: 修改时间(秒)
+    """
+    request, response = ctx.request, ctx.response
+    if etag:
+        response.set_header('ETag', etag)
+    if last_modified is not None:
+        response.set_header('Last-Modified', formatdate(last_modified, usegmt=True))
+    if request.request_method not in ('GET', 'HEAD'):
+        return
+    if_none_match = request.header('If-None-Match')
+    if if_none_match is not None:
+        if etag and _etag_matches(etag, if_none_match):
+            raise notmodified()
+        return
+    if_modified_since = request.header('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        t = parsedate_tz(if_modified_since)
+        if t and int(last_modified) <= mktime_tz(t):
+            raise notmodified()
+##################################################################
+
+######################响应压缩######################
+# 小于该字节数的body不压缩
+_COMPRESS_MIN_SIZE = 1024
+
+# 优先使用的压缩算法，brotli需要安装brotli模块
+_ENCODINGS = ('br', 'gzip', 'deflate') if brotli else ('gzip', 'deflate')
+
+# 已经压缩过的MIME类型，再压缩没有效果
+_COMPRESSED_TYPES = frozenset([
+    'application/octet-stream', 'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/pdf', 'font/woff', 'font/woff2', 'application/font-woff'
+])
+
+# 预压缩的静态文件的后缀
+_PRECOMPRESSED_EXTS = dict(br='.br', gzip='.gz', deflate='.zz')
+
+def _accept_encoding(accept, encodings=_ENCODINGS):
+    """
+    根据请求头Accept-Encoding选择压缩算法，不能压缩时返回None
+    :param encodings: 可以使用的压缩算法，按优先级排列
+
+    >>> _accept_encoding('gzip;q=0, deflate')
+    'deflate'
+    >>> _accept_encoding('br, gzip', ['gzip'])
+    'gzip'
+    >>> _accept_encoding('identity') is None
+    True
+    >>> _accept_encoding(None) is None
+    True
+    """
+    if not accept:
+        return None
+    weights = dict()
+    for part in accept.split(','):
+        params = part.strip().split(';')
+        q = 1.0
+        for param in params[1:]:
+            k, sep, v = param.strip().partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        weights[params[0].strip().lower()] = q
+    for encoding in encodings:
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def _compressible(content_type):
+    """
+    >>> _compressible('text/html; charset=utf-8')
+    True
+    >>> _compressible('image/png')
+    False
+    >>> _compressible('image/svg+xml')
+    True
+    """
+    if not content_type:
+        return False
+    t = content_type.split(';')[0].strip().lower()
+    if t in _COMPRESSED_TYPES:
+        return False
+    if t.startswith('image/'):
+        return t == 'image/svg+xml'
+    return not (t.startswith('video/') or t.startswith('audio/'))
+
+def _compress_stream(chunks, encoding, flush=False):
+    """
+    流式压缩：每读取一块数据就压缩并返回，不需要读入全部数据。
+    :param flush: 每一块数据压缩后立即输出(Z_SYNC_FLUSH)，用于流式响应，客户端不需要等待压缩器的缓冲区填满
+
+    >>> zlib.decompress(''.join(_compress_stream(['hello ', 'world'], 'gzip')), zlib.MAX_WBITS | 16)
+    'hello world'
+    >>> chunks = list(_compress_stream(['hello ', 'world'], 'deflate', flush=True))
+    >>> zlib.decompressobj().decompress(chunks[0])
+    'hello '
+    """
+    if encoding == 'br':
+        c = brotli.Compressor()
+        compress, finish = getattr(c, 'process', None) or c.compress, c.finish
+        sync = getattr(c, 'flush', None)
+    else:
+        # gzip格式的wbits加16，deflate使用zlib格式
+        c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS)
+        compress, finish = c.compress, c.flush
+        sync = lambda: c.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for chunk in chunks:
+            data = compress(chunk)
+            if flush and sync:
+                data = data + sync()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def _add_vary(response, name):
+    vary = response.header('Vary')
+    if not vary:
+        response.set_header('Vary', name)
+    elif name.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        response.set_header('Vary', '%s, %s' % (vary, name))
+
+def _should_compress(body):
+    """
+    200响应的body是否按Accept-Encoding压缩(响应需要Vary: Accept-Encoding)
+    """
+    response = ctx.response
+    if response.status_code != 200 or response.header('Content-Encoding') or not _compressible(response.content_type):
+        return False
+    if hasattr(response, '_no_compress'):
+        # 静态文件已经选择了压缩方式(没有预压缩文件的大文件不压缩)
+        return False
+    if isinstance(body, str) and len(body) < _COMPRESS_MIN_SIZE:
+        return False
+    return not isinstance(body, (list, tuple))
+
+def _compress_response(body, variants=None, head=False):
+    """
+    按Accept-Encoding压缩200响应：str压缩后设置Content-Length，迭代对象按块流式压缩。
+    :param variants: 保存str压缩后的内容的dict(encoding -> str)，如页面缓存的条目，同一个body只压缩一次
+    :param head: HEAD请求只设置与GET相同的响应头(Vary、Content-Encoding、压缩后的Content-Length)，
+                 不包装迭代对象，流式模板按流式响应处理
+    :return: 压缩后的body，不压缩时返回原来的body
+    """
+    if not _should_compress(body):
+        return body
+    response = ctx.response
+    _add_vary(response, 'Accept-Encoding')
+    encoding = _accept_encoding(ctx.request.header('Accept-Encoding'))
+    if encoding is None:
+        return body
+    response.set_header('Content-Encoding', encoding)
+    if isinstance(body, str):
+        data = variants.get(encoding) if variants is not None else None
+        if data is None:
+            data = ''.join(_compress_stream((body,), encoding))
+            if variants is not None:
+                variants[encoding] = data
+        response.content_length = len(data)
+        return data
+    response.unset_header('Content-Length')
+    if head:
+        return body
+    return _compress_stream(body, encoding, isinstance(body, types.GeneratorType))
+
+def _precompressed(fpath, mtime, encoding):
+    """
+    返回build_assets()生成的预压缩文件(如a.css.gz)，不存在或比原文件旧时返回None。
+    请求时不压缩大文件，也不在static目录中写文件。
+    """
+    cpath = fpath + _PRECOMPRESSED_EXTS[encoding]
+    try:
+        if os.stat(cpath).st_mtime >= mtime:
+            return cpath
+    except OSError:
+        pass
+    return None
+##################################################################
+
+class _StaticFile(object):
+    """
+    一个静态文件的元数据和内容：MIME类型、ETag等只在文件改变时计算一次。
+    """
+    __slots__ = ('fpath', 'size', 'mtime', 'ino', 'etag', 'content_type', 'compressible', 'immutable', 'data', 'variants', 'nbytes', 'checked')
+
+    def __init__(self, fpath, st, data):
+        self.fpath = fpath
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        fext = os.path.splitext(fpath)[1]  # 分离文件名与扩展名；默认返回(fname,fextension)元组，可做分片操作。
+        self.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')  # 根据文件后缀得到MIME类型
+        self.compressible = st.st_size >= _COMPRESS_MIN_SIZE and _compressible(self.content_type)
+        self.immutable = _RE_FINGERPRINTED.search(fpath) is not None
+        self.data = data  # str或mmap，为None时不缓存内容
+        self.variants = dict()  # 压缩算法 -> 压缩后的内容
+        self.nbytes = len(data) if data is not None else 0
+        self.checked = time.time()
+
+    def body(self, start=0, end=None):
+        """
+        返回缓存的内容[start:end]，mmap按块返回，只复制需要的部分
+        """
+        end = self.size if end is None else end
+        if start == 0 and end == self.size and isinstance(self.data, str):
+            return [self.data]
+        return self.chunks(start, end)
+
+    def chunks(self, start, end, block_size=65536):
+        while start < end:
+            yield self.data[start:min(start + block_size, end)]
+            start = start + block_size
+
+class StaticFileCache(object):
+    """
+    静态文件的LRU缓存，按字节数限制大小：
+    不超过max_file_size的文件读入内存，更大的文件只缓存元数据(通过wsgi.file_wrapper发送)。
+    每隔interval秒检查一次文件的mtime，文件改变后重新加载。
+
+    mmap需要通过mmap_size开启：部署时截断或者原地改写被mmap的文件，读取时进程会收到SIGBUS，
+    所以使用mmap的文件每次读取之前都检查大小、inode和mtime，只适合部署时整体替换(rename)文件的情况。
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, mmap_size=None, max_file_size=4 * 1024 * 1024, interval=2.0):
+        """
+        :param max_bytes: 缓存的最大字节数(包括压缩后的内容)
+        :param mmap_size: 不小于该字节数的文件使用mmap，默认为None，不使用mmap
+        :param max_file_size: 大于该字节数的文件不缓存内容
+        :param interval: 检查文件mtime的间隔秒数
+        """
+        self.max_bytes = max_bytes
+        self.mmap_size = mmap_size
+        self.max_file_size = max_file_size
+        self.interval = interval
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict()  # fpath -> _StaticFile
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, fpath):
+        """
+        :return: _StaticFile，文件不存在时抛出404
+        """
+        with self._lock:
+            f = self._files.pop(fpath, None)
+            if f is not None:
+                self._files[fpath] = f
+        now = time.time()
+        if f is not None and now - f.checked < self.interval and not isinstance(f.data, mmap.mmap):
+            return f
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self._remove(fpath)
+            raise notfound()
+        if f is not None and f.mtime == st.st_mtime and f.size == st.st_size and f.ino == st.st_ino:
+            f.checked = now
+            return f
+        f = _StaticFile(fpath, st, self._load(fpath, st.st_size))
+        with self._lock:
+            old = self._files.pop(fpath, None)
+            if old is not None:
+                self.nbytes = self.nbytes - old.nbytes
+            self._files[fpath] = f
+            self.nbytes = self.nbytes + f.nbytes
+            self._evict()
+        return f
+
+    def _load(self, fpath, size):
+        if size == 0 or size > self.max_file_size or size > self.max_bytes:
+            return None
+        with open(fpath, 'rb') as fp:
+            if self.mmap_size is None or size < self.mmap_size:
+                return fp.read()
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def variant(self, f, encoding):
+        """
+        缓存的文件压缩后的内容，只压缩一次
+        """
+        data = f.variants.get(encoding)
+        if data is None:
+            data = ''.join(_compress_stream(f.body(), encoding))
+            with self._lock:
+                if encoding not in f.variants:
+                    f.variants[encoding] = data
+                    f.nbytes = f.nbytes + len(data)
+                    if self._files.get(f.fpath) is f:
+                        self.nbytes = self.nbytes + len(data)
+                        self._evict()
+        return data
+
+    def _remove(self, fpath):
+        with self._lock:
+            f = self._files.pop(fpath, None)
+            if f is not None:
+                self.nbytes = self.nbytes - f.nbytes
+
+    def _evict(self):
+        # 淘汰最久没有使用的文件，mmap在没有引用之后自动关闭
+        while self.nbytes > self.max_bytes and len(self._files) > 1:
+            fpath, f = self._files.popitem(last=False)
+            self.nbytes = self.nbytes - f.nbytes
+
+def _safe_path(base, path):
+    """
+    将path拼接到base目录下，规范化之后不在base之内（如包含'..'或符号链接指向外部）的返回None
+
+    >>> _safe_path('/srv/www/static', 'css/a.css')
+    '/srv/www/static/css/a.css'
+    >>> _safe_path('/srv/www/static', 'css/../a.css')
+    '/srv/www/static/a.css'
+    >>> _safe_path('/srv/www/static', '../secret.py') is None
+    True
+    >>> _safe_path('/srv/www/static', '/etc/passwd') is None
+    True
+    >>> _safe_path('/srv/www/static', '../static2/a.css') is None
+    True
+    """
+    base = os.path.realpath(base)
+    fpath = os.path.realpath(os.path.join(base, path))
+    if fpath.startswith(base + os.sep):
+        return fpath
+    return None
+
+class StaticFileRoute(object):
+    """
+    处理/static/下的静态文件，文件的内容和元数据保存在StaticFileCache中。
+    """
+    def __init__(self, cache=None):
         self.method = 'GET'
         self.is_static = False
         self.route = re.compile('^/static/(.+)$')
+        self.cache = StaticFileCache() if cache is None else cache
 
     def match(self, url):
         if url.startswith('/static/'):
@@ -569,12 +1181,139 @@ class StaticFileRoute(object):
         return None
 
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])  # 将多个路径组合后并返回。
-        if not os.path.isfile(fpath):  # 如果fpath是一个存在的文件，返回True。否则返回False。
+        root = ctx.application.document_root
+        # args[0]为'static/...'，只允许访问static目录之内的文件：
+        name = args[0][len('static/'):]
+        fpath = _safe_path(os.path.join(root, 'static'), name)
+        if fpath is None:
             raise notfound()
-        fext = os.path.splitext(fpath)[1]  # 分离文件名与扩展名；默认返回(fname,fextension)元组，可做分片操作。
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')  # 根据文件后缀得到MIME类型
-        return _static_file_generator(fpath)
+        if _RE_FINGERPRINTED.search(name):
+            # build_assets()生成的带指纹的文件在dist目录中：
+            dist = _safe_path(os.path.join(root, 'dist', 'static'), name)
+            try:
+                if dist is None:
+                    raise notfound()
+                f = self.cache.get(dist)
+            except HttpError:
+                f = self.cache.get(fpath)
+        else:
+            f = self.cache.get(fpath)
+        # 在读取文件之前检查客户端的缓存：
+        _check_not_modified(f.etag, f.mtime)
+        response = ctx.response
+        response._no_compress = True
+        response.set_header('Accept-Ranges', 'bytes')
+        if f.immutable:
+            response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        response.content_type = f.content_type
+        r = _parse_range(ctx.request.header('Range'), f.size) if _if_range(f.etag, f.mtime) else None
+        if r:
+            # 部分内容，不压缩：
+            start, end = r
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, f.size))
+            response.content_length = end - start + 1
+            if f.data is not None:
+                return f.body(start, end + 1)
+            return _static_file_generator(f.fpath, start, end - start + 1)
+        response.content_length = f.size
+        if f.compressible:
+            _add_vary(response, 'Accept-Encoding')
+            accept = ctx.request.header('Accept-Encoding')
+            if f.data is not None:
+                encoding = _accept_encoding(accept)
+                if encoding:
+                    # 压缩后的内容使用弱ETag：
+                    response.set_header('Content-Encoding', encoding)
+                    response.set_header('ETag', 'W/' + f.etag)
+                    data = self.cache.variant(f, encoding)
+                    response.content_length = len(data)
+                    return [data]
+            else:
+                # 不缓存内容的大文件只使用build_assets()预压缩的文件，没有时不压缩：
+                variants = dict([(e, _precompressed(f.fpath, f.mtime, e)) for e in _ENCODINGS])
+                encoding = _accept_encoding(accept, [e for e in _ENCODINGS if variants[e]])
+                if encoding:
+                    response.set_header('Content-Encoding', encoding)
+                    response.set_header('ETag', 'W/' + f.etag)
+                    response.content_length = os.path.getsize(variants[encoding])
+                    return _send_file(variants[encoding])
+        if f.data is not None:
+            return f.body()
+        return _send_file(f.fpath)
+
+######################静态资源指纹######################
+def build_assets(document_root, dist_dir=None):
+    """
+    为document_root/static下的文件生成带指纹(内容的md5)的副本和gzip预压缩文件，
+    保存到dist_dir/static下，并生成dist_dir/manifest.json：
+        {"css/app.css": "css/app.3f2a9c1d.css", ...}
+    :param dist_dir: 默认为document_root/dist
+    :return: manifest
+    """
+    static_dir = os.path.join(document_root, 'static')
+    dist_dir = dist_dir or os.path.join(document_root, 'dist')
+    manifest = dict()
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        for fname in filenames:
+            fbase, fext = os.path.splitext(fname)
+            # 跳过预压缩的文件和已经带指纹的文件：
+            if fext in _PRECOMPRESSED_EXTS.values() or _RE_FINGERPRINTED.search(fname):
+                continue
+            src = os.path.join(dirpath, fname)
+            with open(src, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:8]
+            name = os.path.relpath(src, static_dir).replace(os.sep, '/')
+            fingerprinted = '%s.%s%s' % (name[:len(name) - len(fext)], digest, fext)
+            dst = os.path.join(dist_dir, 'static', *fingerprinted.split('/'))
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if not os.path.isfile(dst):
+                shutil.copy2(src, dst)
+            content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+            if os.path.getsize(src) >= _COMPRESS_MIN_SIZE and _compressible(content_type) and not os.path.isfile(dst + '.gz'):
+                with open(src, 'rb') as fin:
+                    with open(dst + '.gz', 'wb') as fout:
+                        # mtime=0使相同的内容生成相同的gzip文件
+                        with gzip.GzipFile(fname, 'wb', 9, fout, 0) as gz:
+                            shutil.copyfileobj(fin, gz)
+            manifest[name] = fingerprinted
+            logging.info('Build asset: %s -> %s' % (name, fingerprinted))
+    if not os.path.isdir(dist_dir):
+        os.makedirs(dist_dir)
+    with open(os.path.join(dist_dir, 'manifest.json'), 'wb') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+class AssetManifest(object):
+    """
+    把静态文件的名称映射为带指纹的url，作为jinja2的filter使用：
+        engine.add_filter('asset', AssetManifest(os.path.join(document_root, 'dist', 'manifest.json')))
+        <link rel="stylesheet" href="{{ 'css/app.css'|asset }}">
+    manifest不存在或者没有该文件时返回不带指纹的url。
+
+    >>> assets = AssetManifest('/not/exist/manifest.json')
+    >>> assets.manifest['css/app.css'] = 'css/app.3f2a9c1d.css'
+    >>> assets('css/app.css')
+    '/static/css/app.3f2a9c1d.css'
+    >>> assets('/js/app.js')
+    '/static/js/app.js'
+    """
+    def __init__(self, path, prefix='/static/'):
+        self.path = path
+        self.prefix = prefix
+        self.manifest = dict()
+        self.reload()
+
+    def reload(self):
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                self.manifest = dict([(k, _to_str(v)) for k, v in json.load(f).iteritems()])
+
+    def __call__(self, name):
+        name = _to_str(name).lstrip('/')
+        return self.prefix + self.manifest.get(name, name)
+##################################################################
 
 # def favicon_handler():
 #     return static_file_handler('/favicon.ico')
@@ -587,9 +1326,133 @@ class MultipartFile(object):
     f.filename  # test.png
     f.file  # file-like object
     """
-    def __init__(self, storage):
-        self.filename = _to_unicode(storage.filename)
-        self.file = storage.file
+    def __init__(self, filename, file, content_type=None):
+        self.filename = _to_unicode(filename)
+        self.file = file
+        self.content_type = content_type
+
+######################请求body的解析######################
+def _too_large():
+    return HttpError(413)
+
+class _MultipartParser(object):
+    """
+    流式解析multipart/form-data：按块读取wsgi.input，不需要把整个body读入内存，
+    文件超过spool_size字节后写入临时文件。同时支持\r\n和\n换行。
+    """
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, fp, boundary, length, max_part_size, max_field_size, spool_size):
+        """
+        :param length: Content-Length，为None时读到wsgi.input结束
+        """
+        self._fp = fp
+        self._remaining = length
+        self._buf = ''
+        self._delimiter = '--' + boundary
+        self._max_part_size = max_part_size
+        self._max_field_size = max_field_size
+        self._spool_size = spool_size
+
+    def _fill(self):
+        n = self.BLOCK_SIZE if self._remaining is None else min(self.BLOCK_SIZE, self._remaining)
+        data = self._fp.read(n) if n > 0 else ''
+        if not data:
+            return False
+        if self._remaining is not None:
+            self._remaining = self._remaining - len(data)
+        self._buf = self._buf + data
+        return True
+
+    def _readline(self):
+        while True:
+            i = self._buf.find('\n')
+            if i >= 0:
+                line = self._buf[:i]
+                self._buf = self._buf[i + 1:]
+                return line.rstrip('\r')
+            if len(self._buf) > self._max_field_size or not self._fill():
+                raise badrequest()
+
+    def parse(self):
+        """
+        :return: [(name, str或MultipartFile), ...]
+        """
+        L = []
+        # 跳过第一个分隔符之前的内容：
+        while True:
+            i = self._buf.find(self._delimiter)
+            if i >= 0:
+                self._buf = self._buf[i + len(self._delimiter):]
+                break
+            self._buf = self._buf[-len(self._delimiter):]
+            if not self._fill():
+                raise badrequest()
+        marker = '\n' + self._delimiter
+        while True:
+            while len(self._buf) < 2 and self._fill():
+                pass
+            if self._buf.startswith('--'):
+                # 最后一个分隔符
+                return L
+            self._readline()
+            # part的headers：
+            name, filename, content_type = None, None, None
+            line = self._readline()
+            while line:
+                k, sep, v = line.partition(':')
+                k = k.strip().lower()
+                if k == 'content-disposition':
+                    disposition, params = cgi.parse_header(v)
+                    name, filename = params.get('name'), params.get('filename')
+                elif k == 'content-type':
+                    content_type = v.strip()
+                line = self._readline()
+            if filename is None:
+                limit = min(self._max_field_size, self._max_part_size)
+                chunks = []
+                sink = chunks.append
+            else:
+                limit = self._max_part_size
+                f = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+                sink = f.write
+            size = 0
+            # part的内容，直到下一个分隔符：
+            while True:
+                i = self._buf.find(marker)
+                if i >= 0:
+                    data = self._buf[:i]
+                    if data.endswith('\r'):
+                        data = data[:-1]
+                    self._buf = self._buf[i + len(marker):]
+                    size = size + len(data)
+                    if size > limit:
+                        raise _too_large()
+                    sink(data)
+                    break
+                # 保留可能是分隔符一部分的结尾：
+                n = len(self._buf) - len(marker) - 1
+                if n > 0:
+                    size = size + n
+                    if size > limit:
+                        raise _too_large()
+                    sink(self._buf[:n])
+                    self._buf = self._buf[n:]
+                if not self._fill():
+                    raise badrequest()
+            if name is None:
+                continue
+            if filename is None:
+                L.append((name, ''.join(chunks)))
+            else:
+                f.seek(0)
+                L.append((name, MultipartFile(filename, f, content_type)))
+##################################################################
+
+def _convert_input(v):
+    if isinstance(v, MultipartFile):
+        return v
+    return _to_unicode(v)
 
 # request对象：
 class Request(object):
@@ -597,26 +1460,84 @@ class Request(object):
     Request object for obtaining all http request information.
     """
 
+    # 请求body的限制，可以修改类属性配置(如 Request.max_body_size = 1024 * 1024 * 1024)，超过时返回413：
+    max_body_size = 128 * 1024 * 1024  # 整个body
+    max_part_size = 100 * 1024 * 1024  # multipart中的一个part(包括文件)
+    max_form_size = 1024 * 1024  # x-www-form-urlencoded的body，multipart中不是文件的part
+    spool_size = 1024 * 1024  # 上传的文件超过该字节数时写入临时文件
+
     def __init__(self, environ):
         self._environ = environ
 
+    def _content_length(self):
+        try:
+            length = int(self._environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            raise badrequest()
+        if length > self.max_body_size:
+            raise _too_large()
+        return length if length >= 0 else None
+
+    def _read_body(self, limit):
+        """
+        读取整个body，超过limit字节时抛出413
+        """
+        length = self._content_length()
+        if length is not None and length > limit:
+            raise _too_large()
+        fp = self._environ['wsgi.input']
+        body = fp.read(length) if length is not None else fp.read(limit + 1)
+        if len(body) > limit:
+            raise _too_large()
+        return body
+
     def _parse_input(self):
-        def _convert(item):
-            if isinstance(item, list):
-                return [_to_unicode(i.value) for i in item]
-            if item.filename:
-                return MultipartFile(item)
-            return _to_unicode(item.value)
-
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
+        """
+        解析query string和body中的参数，值是没有解码的str或者MultipartFile：
+        只有query string时不读取wsgi.input，x-www-form-urlencoded直接解析，multipart/form-data流式解析。
+        x-www-form-urlencoded的body与get_body()共用，两者的调用顺序不影响结果：
+
+        >>> from StringIO import StringIO
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/x-www-form-urlencoded', 'wsgi.input':StringIO('a=1&b=2')})
+        >>> r.get('a'), r.get_body()
+        (u'1', 'a=1&b=2')
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/x-www-form-urlencoded', 'wsgi.input':StringIO('a=1&b=2')})
+        >>> r.get_body(), r.get('b')
+        ('a=1&b=2', u'2')
+        """
         inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        qs = self._environ.get('QUERY_STRING')
+        if qs:
+            for k, v in urlparse.parse_qsl(qs, True):
+                inputs.setdefault(k, []).append(v)
+        method = self._environ.get('REQUEST_METHOD', 'GET')
+        if method in ('GET', 'HEAD'):
+            return inputs
+        content_type, params = cgi.parse_header(self._environ.get('CONTENT_TYPE', ''))
+        if content_type == 'multipart/form-data':
+            boundary = params.get('boundary')
+            if not boundary:
+                raise badrequest()
+            parser = _MultipartParser(self._environ['wsgi.input'], boundary, self._content_length(),
+                                      self.max_part_size, self.max_form_size, self.spool_size)
+            items = parser.parse()
+        elif content_type == 'application/x-www-form-urlencoded' or (not content_type and method == 'POST'):
+            if not hasattr(self, '_body'):
+                self._body = self._read_body(self.max_form_size)
+            elif len(self._body) > self.max_form_size:
+                # 先调用了get_body()，body按max_body_size读取
+                raise _too_large()
+            items = urlparse.parse_qsl(self._body, True)
+        else:
+            items = ()
+        for k, v in items:
+            inputs.setdefault(k, []).append(v)
         return inputs
 
     def _get_raw_input(self):
         """
-        Get raw input as dict containing values as unicode, list or MultipartFile.
+        Get raw input as dict containing values as list of str or MultipartFile.
+        值在读取时才解码为unicode(_convert_input)。
         """
         if not hasattr(self, '_raw_input'):
             self._raw_input = self._parse_input()
@@ -650,10 +1571,7 @@ class Request(object):
         >>> f.file.read()
         'just a test'
         """
-        r = self._get_raw_input()[key]
-        if isinstance(r, list):
-            return r[0]
-        return r
+        return _convert_input(self._get_raw_input()[key][0])
 
     # 根据key返回value：
     def get(self, key, default=None):
@@ -670,10 +1588,10 @@ class Request(object):
         >>> r.get('c')
         u'ABC'
         """
-        r = self._get_raw_input().get(key, default)
-        if isinstance(r, list):
-            return r[0]
-        return r
+        r = self._get_raw_input().get(key)
+        if r is None:
+            return default
+        return _convert_input(r[0])
 
     def gets(self, key):
         """
@@ -690,10 +1608,7 @@ class Request(object):
             ...
         KeyError: 'empty'
         """
-        r = self._get_raw_input()[key]
-        if isinstance(r, list):
-            return r[:]
-        return [r]
+        return [_convert_input(v) for v in self._get_raw_input()[key]]
 
     # 返回key-value的dict：
     def input(self, **kw):
@@ -722,9 +1637,36 @@ class Request(object):
         copy = Dict(**kw)
         raw = self._get_raw_input()
         for k, v in raw.iteritems():
-            copy[k] = v[0] if isinstance(v, list) else v
+            copy[k] = _convert_input(v[0])
         return copy
 
+    @property
+    def json(self):
+        """
+        把body按JSON解码，只解码一次。body为空时返回None，不是JSON时返回400。
+
+        >>> from StringIO import StringIO
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/json', 'wsgi.input':StringIO('{"name": "Bob", "ids": [1, 2]}')})
+        >>> r.json['name']
+        u'Bob'
+        >>> r.json['ids']
+        [1, 2]
+        >>> Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('{bad')}).json
+        Traceback (most recent call last):
+          ...
+        HttpError: 400 Bad Request
+        """
+        if not hasattr(self, '_json'):
+            body = self.get_body()
+            if not body:
+                self._json = None
+            else:
+                try:
+                    self._json = (_fast_json or json).loads(body)
+                except ValueError:
+                    raise badrequest()
+        return self._json
+
     def get_body(self):
         """
         Get raw data from HTTP POST and return as str.
@@ -734,8 +1676,9 @@ class Request(object):
         >>> r.get_body()
         '<xml><raw/>'
         """
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        if not hasattr(self, '_body'):
+            self._body = self._read_body(self.max_body_size)
+        return self._body
 
     @property
     def remote_addr(self):
@@ -813,7 +1756,9 @@ class Request(object):
         >>> r.path_info
         '/test/a b.html'
         '''
-        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+        if not hasattr(self, '_path_info'):
+            self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
 
     @property
     def host(self):
@@ -1200,6 +2145,8 @@ class Template(object):
     """
     模板类
     """
+    stream = False  # 为True时按块输出渲染结果，见view(template_name, stream=True)
+
     def __init__(self, template_name, **kw):
         """
         Init a template object with template name, model as dict, and additional kw that will append to model.
@@ -1223,6 +2170,37 @@ class TemplateEngine(object):
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
+    def stream(self, path, model):
+        """
+        按块渲染模板，返回str的迭代对象
+        """
+        return [self(path, model)]
+
+def _private_dir(path):
+    """
+    创建只有当前用户可以访问的目录(0700)，已存在的目录必须属于当前用户，
+    否则其他用户可以在其中放入伪造的文件(如编译后的模板)
+
+    >>> d = os.path.join(tempfile.mkdtemp(), 'cache')
+    >>> _private_dir(d) == d
+    True
+    >>> oct(stat.S_IMODE(os.stat(d).st_mode))
+    '0700'
+    >>> _private_dir(d) == d
+    True
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise ValueError('Directory %s is not owned by the current user.' % path)
+    if stat.S_IMODE(st.st_mode) & 0077:
+        os.chmod(path, 0700)
+    return path
+
 class Jinja2TemplateEngine(TemplateEngine):
     """
     Render using jinja2 template engine.(结合例子理解)
@@ -1232,12 +2210,40 @@ class Jinja2TemplateEngine(TemplateEngine):
     >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
     >>> engine('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)))
     '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
+    >>> engine.precompile()
+    1
     """
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, bytecode_cache_dir=None, fragment_cache=None, **kw):
+        """
+        :param templ_dir: 模板目录
+        :param bytecode_cache_dir: 保存编译后的模板的目录，多个进程和重启之后都不需要重新编译
+        :param fragment_cache: {% cache %}标签使用的缓存，默认使用fragment_cache
+        :param kw: jinja2 Environment的参数，生产环境可以使用auto_reload=False，不再检查模板文件的修改时间
+        """
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if 'autoescape' not in kw:
             kw['autoescape'] = True
+        if bytecode_cache_dir:
+            kw['bytecode_cache'] = FileSystemBytecodeCache(_private_dir(bytecode_cache_dir))
+        kw['extensions'] = list(kw.get('extensions', ())) + [_fragment_cache_extension()]
         self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)  # 配置jinja2,从系统文件中加载模板
+        self._env.fragment_cache = _default_fragment_cache() if fragment_cache is None else fragment_cache
+
+    @property
+    def fragment_cache(self):
+        return self._env.fragment_cache
+
+    def precompile(self, extensions=None):
+        """
+        启动时加载(编译)模板目录下的所有模板，第一个请求不再需要编译模板。
+        需要在add_filter()之后调用，编译时会检查filter是否存在。
+        :param extensions: 只加载这些后缀的模板，如('html',)
+        :return: 加载的模板数量
+        """
+        names = self._env.list_templates(extensions=extensions)
+        for name in names:
+            self._env.get_template(name)
+        return len(names)
 
     def add_filter(self, name, fn_filter):
         """
@@ -1248,6 +2254,180 @@ class Jinja2TemplateEngine(TemplateEngine):
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
 
+    def stream(self, path, model, buffer_size=8192):
+        """
+        使用jinja2的generate()边渲染边输出，每积累buffer_size字节输出一块。
+        模板在调用时加载，模板不存在等错误在发送响应头之前抛出。
+
+        >>> templ_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
+        >>> engine = Jinja2TemplateEngine(templ_path)
+        >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
+        >>> list(engine.stream('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12))))
+        ['<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>']
+        """
+        return self._generate(self._env.get_template(path), model, buffer_size)
+
+    def _generate(self, template, model, buffer_size):
+        L = []
+        n = 0
+        for s in template.generate(**model):
+            s = s.encode('utf-8')
+            L.append(s)
+            n = n + len(s)
+            if n >= buffer_size:
+                yield ''.join(L)
+                L = []
+                n = 0
+        if L:
+            yield ''.join(L)
+
+######################模板片段缓存######################
+class FragmentCache(object):
+    """
+    {% cache %}标签的缓存，超过size时淘汰最久没有使用的片段。
+    其他缓存(如memcache)只需要实现get(key)、set(key, value, ttl)和invalidate(name)。
+    key是tuple，第一个元素是片段的名称，invalidate(name)清除该名称的所有片段。
+
+    >>> cache = FragmentCache(size=2)
+    >>> cache.set(('sidebar', '1'), u'a', 60)
+    >>> cache.set(('sidebar', '2'), u'b', 60)
+    >>> cache.get(('sidebar', '1'))
+    u'a'
+    >>> cache.set(('tags',), u'c', 60)
+    >>> cache.get(('sidebar', '2')) is None
+    True
+    >>> cache.invalidate('sidebar')
+    1
+    >>> len(cache)
+    1
+    """
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl  # {% cache %}没有指定ttl时使用
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (value, expires)
+        self._names = dict()  # name -> set(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if time.time() >= entry[1]:
+                self._discard(key)
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+            self._names.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.size:
+                k, v = self._entries.popitem(last=False)
+                self._discard(k)
+
+    def _discard(self, key):
+        keys = self._names.get(key[0])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._names[key[0]]
+
+    def invalidate(self, name):
+        """
+        清除名称为name的所有片段，在修改数据后调用：
+        fragment_cache.invalidate('latest_blogs')
+        :return: 清除的片段数
+        """
+        with self._lock:
+            keys = self._names.pop(_to_str(name), ())
+            for key in keys:
+                self._entries.pop(key, None)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._names.clear()
+
+# 默认的片段缓存
+fragment_cache = FragmentCache()
+
+def _default_fragment_cache():
+    return fragment_cache
+
+def _fragment_key(key):
+    """
+    把{% cache %}的key转换为str的tuple，key可以是一个值或者list/tuple
+
+    >>> _fragment_key('sidebar')
+    ('sidebar',)
+    >>> _fragment_key(['blog', 123, 1.5])
+    ('blog', '123', '1.5')
+    >>> _fragment_key(1505462400.123456) == _fragment_key(1505462400.123457)
+    False
+    """
+    if isinstance(key, (list, tuple)):
+        return tuple([_fragment_key_part(k) for k in key])
+    return (_fragment_key_part(key), )
+
+def _fragment_key_part(k):
+    # float使用repr()，str()只保留12位有效数字，时间戳只相差不到1秒时会得到相同的key
+    if isinstance(k, float):
+        return repr(k)
+    return _to_str(k)
+
+_FragmentCacheExtension = None
+
+def _fragment_cache_extension():
+    """
+    {% cache key[, ttl] %}...{% endcache %}标签，缓存渲染后的片段：
+
+        {% cache 'latest_blogs', 60 %}...{% endcache %}
+        {% cache ('blog_comments', blog.id, blog.version) %}...{% endcache %}
+
+    key中包含数据的版本(如version、修改时间)时数据改变后自动使用新的片段。
+    jinja2在需要时才导入，扩展的类只创建一次。
+    """
+    global _FragmentCacheExtension
+    if _FragmentCacheExtension is not None:
+        return _FragmentCacheExtension
+    from jinja2 import nodes, Markup
+    from jinja2.ext import Extension
+
+    class FragmentCacheExtension(Extension):
+        tags = set(['cache'])
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            args = [parser.parse_expression()]
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(nodes.Const(None))
+            body = parser.parse_statements(['name:endcache'], drop_needle=True)
+            return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+        def _cache(self, key, ttl, caller):
+            cache = getattr(self.environment, 'fragment_cache', None)
+            if cache is None:
+                return caller()
+            key = _fragment_key(key)
+            value = cache.get(key)
+            if value is None:
+                value = caller()
+                cache.set(key, value, ttl)
+            return Markup(value)
+
+    _FragmentCacheExtension = FragmentCacheExtension
+    return _FragmentCacheExtension
+##################################################################
+
 def _default_error_handler(e, start_response, is_debug):
     if isinstance(e, HttpError):
         logging.info('HttpError: %s' % e.status)
@@ -1262,9 +2442,11 @@ def _default_error_handler(e, start_response, is_debug):
     return r'<html><body><h1>500 Internal Server Error</h1><h3>%s</h3></body></html>' % str(e)
 
 # 装饰器--模板视图：
-def view(template_name):
+def view(template_name, stream=False):
     """
     A view decorator that render a view by dict.
+    stream=True时边渲染边输出(没有ETag和Content-Length)，适合很长的页面，
+    model中可以使用按批查询的迭代对象(如Query.iterate())，第一个字节更早到达客户端。
 
     >>> @view('test/view.html')
     ... def hello():
@@ -1288,12 +2470,329 @@ def view(template_name):
             r = func(*args, **kw)
             if isinstance(r, dict):
                 logging.info('return Template')
-                return Template(template_name, **r)
+                t = Template(template_name, **r)
+                t.stream = stream
+                return t
             raise ValueError('Expect return a dict when using @view() decorator.')
         return _wrapper
     return _decorator
 ##################################################################
 
+######################页面缓存######################
+class PageCache(object):
+    """
+    保存@cached页面的最终响应(status, headers, 编码后的body, 过期时间, 压缩后的body)，
+    超过size时淘汰最久没有使用的页面。
+
+    >>> cache = PageCache(size=2)
+    >>> cache.set(('/', ''), '/', ('200 OK', [], 'a', time.time() + 60, {}))
+    >>> cache.set(('/blog', ''), '/blog', ('200 OK', [], 'b', time.time() + 60, {}))
+    >>> cache.get(('/', ''))[2]
+    'a'
+    >>> cache.set(('/about', ''), '/about', ('200 OK', [], 'c', time.time() + 60, {}))
+    >>> cache.get(('/blog', '')) is None
+    True
+    >>> cache.purge('/')
+    1
+    >>> len(cache)
+    1
+    >>> event, leader = cache.begin(('/', ''))
+    >>> leader, cache.begin(('/', ''))[1]
+    (True, False)
+    >>> cache.end(('/', ''))
+    >>> event.is_set(), cache.begin(('/', ''))[1]
+    (True, True)
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (status, headers, body, expires, variants)
+        self._paths = dict()  # path -> set(key)，用于按path清除
+        # single-flight：正在重新生成的页面，key -> Event，生成结束后删除
+        self._flights = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, path, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            self._paths.setdefault(path, set()).add(key)
+            while len(self._entries) > self.size:
+                k, v = self._entries.popitem(last=False)
+                self._discard(k)
+
+    def _discard(self, key):
+        keys = self._paths.get(key[0])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._paths[key[0]]
+
+    def begin(self, key):
+        """
+        开始重新生成key的页面
+        :return: (event, leader)，leader为False时其他线程正在生成该页面，可以等待event
+        """
+        with self._lock:
+            event = self._flights.get(key)
+            if event is not None:
+                return event, False
+            event = self._flights[key] = threading.Event()
+            return event, True
+
+    def end(self, key):
+        """
+        页面生成结束(成功或失败)，唤醒等待的线程
+        """
+        with self._lock:
+            event = self._flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def purge(self, path):
+        """
+        清除path的所有缓存页面(不同的query string和vary)，在修改数据后调用：
+        page_cache.purge('/')
+        :return: 清除的页面数
+        """
+        with self._lock:
+            keys = self._paths.pop(path, ())
+            for key in keys:
+                self._entries.pop(key, None)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+
+# 默认的页面缓存
+page_cache = PageCache()
+
+def _replay(entry):
+    """
+    用缓存的页面设置ctx.response，返回body(客户端支持时返回缓存的压缩后的body)
+    """
+    status, headers, body, expires, variants = entry
+    response = ctx.response
+    response.status = status
+    for k, v in headers:
+        response.set_header(k, v)
+    # 缓存的页面已经有ETag，客户端的缓存有效时不返回body，304与200的Vary相同：
+    if _should_compress(body):
+        _add_vary(response, 'Accept-Encoding')
+    _check_not_modified(response.header('ETag'))
+    return _compress_response(body, variants)
+
+def _render(func, args, kw):
+    """
+    执行处理函数并渲染模板，返回编码后的str(或者处理函数返回的其他body)
+    """
+    r = func(*args, **kw)
+    if isinstance(r, Template):
+        r = ctx.application.template_engine(r.template_name, r.model)
+    if isinstance(r, unicode):
+        r = r.encode('utf-8')
+    return r
+
+# 装饰器--页面缓存：
+def cached(ttl=60, stale=0, vary=(), cookies=(), cache=None):
+    """
+    A @cached decorator that caches the final response of a GET handler.
+    缓存的key是path + query string + vary中的请求头 + cookies中的cookie，只缓存没有设置cookie的200响应。
+    页面过期后的stale秒内，一个线程重新生成页面，其他线程直接返回过期的页面。
+
+    @get('/')
+    @cached(ttl=60, cookies=['awesession'])
+    @view('index.html')
+    def index():
+        ...
+
+    :param ttl: 缓存的秒数
+    :param stale: 过期后还可以返回旧页面的秒数
+    :param vary: 影响页面内容的请求头
+    :param cookies: 影响页面内容的cookie
+    :param cache: PageCache，默认使用page_cache
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            c = page_cache if cache is None else cache
+            request = ctx.request
+            path = request.path_info
+            key = (path, request.query_string, tuple([request.header(h) for h in vary]), tuple([request.cookie(n) for n in cookies]))
+            now = time.time()
+            entry = c.get(key)
+            if entry is not None and now < entry[3]:
+                return _replay(entry)
+            event, leader = c.begin(key)
+            if not leader:
+                if entry is not None and now < entry[3] + stale:
+                    # 其他线程正在重新生成页面
+                    return _replay(entry)
+                event.wait()
+                latest = c.get(key)
+                if latest is not None and time.time() < latest[3]:
+                    return _replay(latest)
+                # 其他线程生成失败或者页面不能缓存，自己生成(不再缓存)
+                return _render(func, args, kw)
+            try:
+                latest = c.get(key)
+                if latest is not None and latest is not entry and time.time() < latest[3]:
+                    # 其他线程刚刚生成了页面
+                    return _replay(latest)
+                r = _render(func, args, kw)
+                response = ctx.response
+                if isinstance(r, str) and response.status_code == 200 and not hasattr(response, '_cookies'):
+                    if response.header('ETag') is None:
+                        response.set_header('ETag', _etag(r))
+                    # 下游的缓存按vary中的请求头和cookie区分页面：
+                    for h in vary:
+                        _add_vary(response, h)
+                    if cookies:
+                        _add_vary(response, 'Cookie')
+                    variants = {}
+                    c.set(key, path, (response.status, response._headers.items(), r, time.time() + ttl, variants))
+                    r = _compress_response(r, variants)
+                return r
+            finally:
+                c.end(key)
+        return _wrapper
+    return _decorator
+##################################################################
+
+######################JSON######################
+# 超过该数量的list按块输出JSON数组
+_JSON_STREAM_SIZE = 1000
+
+_JSON_SCALARS = (basestring, bool, int, long, float)
+
+def _load_unloaded(items):
+    """
+    orm的Model对象(或只读的对象)没有加载的字段(延迟加载的字段、投影查询未选中的字段)按Model一次查询加载，
+    JSON中包含所有字段，而不是取决于对象的加载方式
+    """
+    groups = dict()
+    for o in items:
+        if o is None or isinstance(o, _JSON_SCALARS):
+            continue
+        model = getattr(type(o), '__model__', type(o))
+        if hasattr(model, 'load_unloaded'):
+            groups.setdefault(model, []).append(o)
+    for model, L in groups.iteritems():
+        model.load_unloaded(L)
+
+def _json_value(o, loaded=False):
+    """
+    把值转换为JSON模块可以直接序列化的类型，不依赖JSON模块对default参数的支持：
+    有keys()和[]的对象(db.Dict、Model、只读的Model)转换为dict，日期转换为ISO格式，Decimal转换为float，set转换为list
+    :param loaded: 是否已经加载了Model没有加载的字段
+
+    >>> sorted(_json_value(dict(d=datetime.date(2017, 9, 15), n=decimal.Decimal('1.5'), s=set([1]))).items())
+    [('d', '2017-09-15'), ('n', 1.5), ('s', [1])]
+    """
+    if o is None or isinstance(o, _JSON_SCALARS):
+        return o
+    if isinstance(o, (list, tuple)):
+        _load_unloaded(o)
+        return [_json_value(v, True) for v in o]
+    if hasattr(o, 'keys') and hasattr(o, '__getitem__'):
+        if not loaded:
+            _load_unloaded((o, ))
+        return dict([(k, _json_value(o[k])) for k in o.keys()])
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (set, frozenset)):
+        return [_json_value(v) for v in o]
+    raise TypeError('%r is not JSON serializable' % o)
+
+def _json_encode(value):
+    """
+    序列化_json_value()转换后的值，优先使用快速的JSON模块
+    """
+    if _fast_json is not None:
+        return _fast_json.dumps(value)
+    return json.dumps(value, sort_keys=True)
+
+def _json_dumps(obj):
+    """
+    把dict、list、db.Dict、orm.Model等序列化为str，各个JSON模块的输出一致。
+
+    >>> json.loads(_json_dumps(Dict(name=u'Bob', ids=[1, 2])))['ids']
+    [1, 2]
+    >>> json.loads(_json_dumps(dict(d=datetime.date(2017, 9, 15))))['d']
+    u'2017-09-15'
+    """
+    return _json_encode(_json_value(obj))
+
+def _json_stream(items, batch_size=100):
+    """
+    按块输出JSON数组，每块转换并序列化batch_size个元素(Model没有加载的字段每块一次查询)
+
+    >>> ''.join(_json_stream(iter(range(5)), 2))
+    '[0,1,2,3,4]'
+    >>> ''.join(_json_stream([]))
+    '[]'
+    """
+    yield '['
+    sep = ''
+    L = []
+    for item in items:
+        L.append(item)
+        if len(L) >= batch_size:
+            yield sep + ','.join([_json_encode(v) for v in _json_value(L)])
+            sep = ','
+            L = []
+    if L:
+        yield sep + ','.join([_json_encode(v) for v in _json_value(L)])
+    yield ']'
+
+# 装饰器--JSON API：
+def api(func):
+    """
+    A @api decorator that returns the result as JSON.
+    dict、db.Dict、Model直接序列化；很长的list和迭代对象(如orm的Query)按块输出JSON数组。
+    Model包含所有字段，延迟加载的字段(和投影查询未选中的字段)按Model批量查询加载，
+    不需要这些字段时应该返回只包含需要的字段的dict。
+
+    @get('/api/blogs')
+    @api
+    def api_blogs():
+        return Blog.find_all()
+
+    >>> @api
+    ... def test():
+    ...     return dict(ok=True)
+    >>> ctx.response = Response()
+    >>> json.loads(test())
+    {u'ok': True}
+    >>> ctx.response.content_type
+    'application/json; charset=utf-8'
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        r = func(*args, **kw)
+        ctx.response.content_type = 'application/json; charset=utf-8'
+        if isinstance(r, list):
+            if len(r) > _JSON_STREAM_SIZE:
+                return _json_stream(r)
+        elif hasattr(r, '__iter__') and not hasattr(r, 'keys') and not isinstance(r, tuple):
+            return _json_stream(r)
+        return _json_dumps(r)
+    return _wrapper
+##################################################################
+
 ######################拦截器(嵌套装饰器，有点绕)######################
 _RE_INTERCEPTOR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 _RE_INTERCEPTOR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
@@ -1328,25 +2827,30 @@ def interceptor(pattern='/'):
         return func
     return _decorator
 
-# 装饰器--拦截器function
-def _build_interceptor_fn(func, next_fn):
+# 找出匹配path的拦截器
+def _match_interceptors(path, interceptors):
     """
-    通过调用特殊属性(__interceptor__:该属性是一个对'拦截器模式'进行匹配的函数，该函数根据匹配成功与否返回True或False)
-    返回的boolean值，来判断是否在方法next_fn外层嵌套方法func。
-    :param func: 外层方法
-    :param next_fn: 内层方法
+    调用拦截器的特殊属性__interceptor__，返回匹配path的拦截器list，顺序不变。
+
+    >>> @interceptor('/manage/')
+    ... def f1(next_fn):
+    ...     return next_fn()
+    >>> @interceptor('*.html')
+    ... def f2(next_fn):
+    ...     return next_fn()
+    >>> [f.__name__ for f in _match_interceptors('/manage/blogs.html', (f1, f2))]
+    ['f1', 'f2']
+    >>> [f.__name__ for f in _match_interceptors('/api/blogs', (f1, f2))]
+    []
     """
-    def _wrapper():
-        if func.__interceptor__(ctx.request.path_info):
-            return func(next_fn)
-        else:
-            return next_fn()
-    return _wrapper
+    return [f for f in interceptors if f.__interceptor__(path)]
 
 # 构建拦截器链
 def _build_interceptor_chain(last_fn, *interceptors):
     """
     Build interceptor chain.
+    拦截器在构建时已经按path筛选过(_match_interceptors)，调用时不再匹配path，
+    每个拦截器只是一次函数调用：f1(f2(f3(last_fn)))。
 
     >>> def target():
     ...     print 'target'
@@ -1369,8 +2873,7 @@ def _build_interceptor_chain(last_fn, *interceptors):
     ...         return next_fn()
     ...     finally:
     ...         print 'after f3()'
-    >>> chain = _build_interceptor_chain(target, f1, f2, f3)
-    >>> ctx.request = Dict(path_info='/test/abc')
+    >>> chain = _build_interceptor_chain(target, *_match_interceptors('/test/abc', (f1, f2, f3)))
     >>> chain()
     before f1()
     before f2()
@@ -1379,7 +2882,7 @@ def _build_interceptor_chain(last_fn, *interceptors):
     after f3()
     after f2()
     123
-    >>> ctx.request = Dict(path_info='/api/')
+    >>> chain = _build_interceptor_chain(target, *_match_interceptors('/api/', (f1, f2, f3)))
     >>> chain()
     before f1()
     before f3()
@@ -1387,11 +2890,9 @@ def _build_interceptor_chain(last_fn, *interceptors):
     after f3()
     123
     """
-    L = list(interceptors)
-    L.reverse()  # 反向list中的元素
     fn = last_fn
-    for f in L:
-        fn = _build_interceptor_fn(f, fn)
+    for f in reversed(interceptors):
+        fn = functools.partial(f, fn)
     return fn
 ##################################################################
 
@@ -1418,6 +2919,9 @@ def _load_module(module_name):
     m = __import__(from_module, globals(), locals(), [import_module])
     return getattr(m, import_module)
 
+# 按(method, path)缓存的动态路由拦截器链的最大数量
+_CHAIN_CACHE_SIZE = 10000
+
 class WSGIApplication(object):
 
     def __init__(self, document_root=None):
@@ -1432,11 +2936,9 @@ class WSGIApplication(object):
         self._interceptors = []
         self._template_engine = None
 
-        self._get_static = {}
-        self._post_static = {}
-
-        self._get_dynamic = []
-        self._post_dynamic = []
+        # 每个method一个路由表：
+        self._static = dict([(m, {}) for m in _METHODS])
+        self._dynamic = dict([(m, RouteTrie()) for m in _METHODS])
 
     def _check_not_running(self):
         if self._running:
@@ -1465,16 +2967,12 @@ class WSGIApplication(object):
     def add_url(self, func):
         self._check_not_running()
         route = Route(func)
+        if route.method not in _METHODS:
+            raise ValueError('Unsupported method %s of route: %s' % (route.method, route.path))
         if route.is_static:
-            if route.method == 'GET':
-                self._get_static[route.path] = route
-            if route.method == 'POST':
-                self._post_static[route.path] = route
+            self._static[route.method][route.path] = route
         else:
-            if route.method == 'GET':
-                self._get_dynamic.append(route)
-            if route.method == 'POST':
-                self._post_dynamic.append(route)
+            self._dynamic[route.method].add(route)
         logging.info('Add route: %s' % str(route))
 
     # 添加一个Interceptor定义：
@@ -1490,37 +2988,130 @@ class WSGIApplication(object):
         server.serve_forever()
 
     # 返回WSGI处理函数：
-    def get_wsgi_application(self, debug=False):
+    def get_wsgi_application(self, debug=False, serve_static=False, static_cache=None):
+        """
+        :param debug: 调试模式，显示错误的堆栈，并且处理/static/下的文件
+        :param serve_static: 非调试模式时也处理/static/下的文件
+        :param static_cache: 静态文件使用的StaticFileCache，用于设置max_bytes、mmap_size、interval等参数
+        """
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        static_file = StaticFileRoute(static_cache) if debug or serve_static else None
         self._running = True
 
-        _application = Dict(document_root=self._document_root)
+        _application = Dict(document_root=self._document_root, template_engine=self._template_engine)
+
+        interceptors = tuple(self._interceptors)
+        statics = self._static
+        dynamics = self._dynamic
+
+        # 静态路由的拦截器链在启动时构建：
+        static_chains = dict()
+        for method, routes in statics.iteritems():
+            static_chains[method] = dict([(path, _build_interceptor_chain(route, *_match_interceptors(path, interceptors))) for path, route in routes.iteritems()])
+        # HEAD使用GET的路由：
+        static_chains['HEAD'] = static_chains['GET']
+        # 动态路由的拦截器链按(method, path)缓存，path确定时路由和参数也确定：
+        dynamic_chains = dict()
+
+        def _match(method, path_info):
+            if path_info in statics[method]:
+                return functools.partial(statics[method][path_info])
+            r = dynamics[method].match(path_info)
+            if r:
+                return functools.partial(r[0], *r[1])
+            if static_file and method == 'GET':
+                args = static_file.match(path_info)
+                if args:
+                    return functools.partial(static_file, *args)
+            return None
+
+        def _allowed(path_info):
+            """
+            path可以使用的method
+            """
+            L = [m for m in _METHODS if _match(m, path_info)]
+            if 'GET' in L:
+                L.insert(L.index('GET') + 1, 'HEAD')
+            if L:
+                L.append('OPTIONS')
+            return L
+
+        def _options(allow):
+            ctx.response.set_header('Allow', ', '.join(allow))
+            ctx.response.content_length = 0
+            return None
+
+        def _notfound():
+            raise notfound()
 
-        def fn_route():
+        def _methodnotallowed(allow):
+            ctx.response.set_header('Allow', ', '.join(allow))
+            raise methodnotallowed()
+
+        def fn_route(request_method, path_info):
+            """
+            查找路由，返回不带参数的处理函数
+            """
+            if request_method == 'HEAD':
+                request_method = 'GET'
+            if request_method in dynamics:
+                fn = _match(request_method, path_info)
+                if fn:
+                    return fn
+            allow = _allowed(path_info)
+            if not allow:
+                return _notfound
+            if request_method == 'OPTIONS':
+                return functools.partial(_options, allow)
+            return functools.partial(_methodnotallowed, allow)
+
+        def fn_exec():
             request_method = ctx.request.request_method
             path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+            fn = static_chains.get(request_method, {}).get(path_info)
+            if fn:
+                return fn()
+            key = (request_method, path_info)
+            fn = dynamic_chains.get(key)
+            if fn is None:
+                fn = _build_interceptor_chain(fn_route(request_method, path_info), *_match_interceptors(path_info, interceptors))
+                if len(dynamic_chains) >= _CHAIN_CACHE_SIZE:
+                    try:
+                        dynamic_chains.popitem()
+                    except KeyError:
+                        pass
+                dynamic_chains[key] = fn
+            return fn()
+
+        def _check_buffered(body):
+            """
+            200的GET/HEAD响应：设置Content-Length和ETag，客户端的缓存有效时抛出304(与200的Vary相同)
+            """
+            response = ctx.response
+            if response.header('Content-Length') is None:
+                response.content_length = len(body)
+            if _should_compress(body):
+                _add_vary(response, 'Accept-Encoding')
+            if response.status_code == 200 and ctx.request.request_method in ('GET', 'HEAD'):
+                _check_not_modified(response.header('ETag') or _etag(body))
+
+        def _stream_body(chunks, application, request, response):
+            """
+            流式响应：迭代时恢复ctx，unicode编码为utf-8
+            """
+            ctx.application, ctx.request, ctx.response = application, request, response
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, unicode):
+                        chunk = chunk.encode('utf-8')
+                    yield chunk
+            except Exception:
+                # 响应头已经发送，只能记录错误并中断响应
+                logging.exception('Exception in streaming response:')
+                raise
+            finally:
+                chunks.close()
+                ctx.application, ctx.request, ctx.response = None, None, None
 
         def wsgi(env, start_response):
             ctx.application = _application
@@ -1528,12 +3119,37 @@ class WSGIApplication(object):
             response = ctx.response = Response()
             try:
                 r = fn_exec()
+                if ctx.request.request_method == 'HEAD':
+                    # HEAD只需要响应头：渲染模板以得到与GET相同的ETag、Content-Length和压缩协商，
+                    # 但不迭代生成响应体(流式模板和生成器)：
+                    if isinstance(r, Template) and not r.stream:
+                        r = self._template_engine(r.template_name, r.model)
+                    if isinstance(r, unicode):
+                        r = r.encode('utf-8')
+                    if isinstance(r, str):
+                        _check_buffered(r)
+                    if r is not None:
+                        # 与GET相同的压缩协商，响应头一致：
+                        _compress_response(r, head=True)
+                    if hasattr(r, 'close'):
+                        r.close()
+                    start_response(response.status, response.headers)
+                    return []
                 if isinstance(r, Template):
-                    r = self._template_engine(r.template_name, r.model)
+                    if r.stream:
+                        r = self._template_engine.stream(r.template_name, r.model)
+                    else:
+                        r = self._template_engine(r.template_name, r.model)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                if isinstance(r, str):
+                    _check_buffered(r)
+                elif isinstance(r, types.GeneratorType):
+                    # 服务器在wsgi()返回之后才迭代body，迭代时需要ctx：
+                    r = _stream_body(r, _application, ctx.request, response)
+                r = _compress_response(r)
                 start_response(response.status, response.headers)
                 return r
             except RedirectError, e:
@@ -1541,6 +3157,11 @@ class WSGIApplication(object):
                 start_response(e.status, response.headers)
                 return []
             except HttpError, e:
+                if e.status.startswith('304'):
+                    response.unset_header('Content-Type')
+                    response.unset_header('Content-Length')
+                    start_response(e.status, response.headers)
+                    return []
                 start_response(e.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
@@ -8,11 +8,13 @@ create time: 2017-09-21
 disc: urls.py
 """
 
-from transwarp.web import get, view
+from transwarp.web import get, view, cached
 from models import User, Blog, Comment
 
-@view('test_users.html')
+# 页面在修改用户后过期，也可以调用 page_cache.purge('/') 立即清除
 @get('/')
+@cached(ttl=60, stale=30)
+@view('test_users.html')
 def test_users():
     users = User.find_all()
     return dict(users=users)
\ No newline at end of file
@@ -14,17 +14,34 @@ import logging; logging.basicConfig(level=logging.INFO)
 import os
 
 from transwarp import db
-from transwarp.web import WSGIApplication, Jinja2TemplateEngine
+from transwarp.orm import ShardRouter
+from transwarp.web import WSGIApplication, Jinja2TemplateEngine, AssetManifest
 
 from config import configs
 
 # 初始化数据库：
 db.create_engine(**configs.db)
 
+# 初始化分片：
+if configs.shards:
+    from models import Comment
+    Comment.__shards__ = ShardRouter([db.make_engine(**c) for c in configs.shards])
+
 # 创建一个WSGIApplication：
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
-# 初始化jinja2模块引擎：
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+# 初始化jinja2模块引擎，编译后的模板保存在www目录下(不使用/tmp等公共目录)：
+bytecode_cache = configs.templates.bytecode_cache
+if bytecode_cache:
+    bytecode_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), bytecode_cache)
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),
+                                       bytecode_cache_dir=bytecode_cache,
+                                       auto_reload=configs.templates.auto_reload)
+
+# 带指纹的静态文件url(由build_assets.py生成)：{{ 'css/app.css'|asset }}
+template_engine.add_filter('asset', AssetManifest(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist', 'manifest.json')))
+
+# 启动时编译所有模板(在添加filter之后)：
+template_engine.precompile()
 
 wsgi.template_engine = template_engine
 